@@ -22,6 +22,20 @@ import cartopy.io.shapereader as shpreader
 from helper_utils import provide_default, to_list
 
 
+def compute_all(*data):
+    """
+    Evaluates lazy (dask-backed) data-arrays together, so the underlying data is only read once.
+    :param data: xarray data-arrays (dask-backed or not)
+    :return: tuple of the evaluated data-arrays
+    """
+    try:
+        import dask
+    except ImportError:
+        return data
+
+    return dask.compute(*data)
+
+
 def plot_cdf(x, y, plot_dict: dict = {}):
     """
     Plot cumulative density function in a x-y plot.
@@ -146,7 +160,7 @@ def plot_precip_lead_time(mean_precip, init_hour, plot_dict: dict = {}):
     quantiles = provide_default(plot_dict, "quantiles", [0.25, 0.75])
     xy_coords = provide_default(plot_dict, "xy_coords", ["Lat", "Long"])
 
-    data_min, data_max = np.amin(mean_precip), np.amax(mean_precip)
+    data_min, data_max = mean_precip.min(), mean_precip.max()
 
     daytimes = [(init_hour + fcst) % 24 for fcst in mean_precip["forecast_hour.hour"].values]
     nhours = len(daytimes)
@@ -157,9 +171,15 @@ def plot_precip_lead_time(mean_precip, init_hour, plot_dict: dict = {}):
         nhours = 24
 
     try:
+        if mean_precip.chunks is not None:
+            # dask-backed data: quantiles need the spatial dimensions in one chunk, time stays chunked
+            mean_precip = mean_precip.chunk({dim: -1 for dim in xy_coords})
         mean_precip_davg = mean_precip.mean(dim=xy_coords)
         mean_precip_q1 = mean_precip.quantile(quantiles[0], dim=xy_coords)
         mean_precip_q2 = mean_precip.quantile(quantiles[1], dim=xy_coords)
+        # evaluate all reductions in one pass over the (possibly out-of-core) data
+        data_min, data_max, mean_precip_davg, mean_precip_q1, mean_precip_q2 = \
+            compute_all(data_min, data_max, mean_precip_davg, mean_precip_q1, mean_precip_q2)
     except ValueError as err:
         print("%{0}: Check if data has dimensions {1}.".format(method, " and ".join(xy_coords)))
         raise err
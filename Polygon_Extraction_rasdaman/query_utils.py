@@ -10,25 +10,313 @@ __author__ = "Michael Langguth"
 __date__ = "2022-03-03"
 
 # import modules
+import os
 import io
+import re
+import json
 import time
+import glob
+import hashlib
+import tempfile
+import threading
 import datetime as dt
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from urllib.error import HTTPError
 import numpy as np
 import xarray as xr
 import pandas as pd
 
 
+class Query_Cache(object):
+    """
+    Content-addressed on-disk cache of NetCDF query responses.
+    Files are named by the SHA1 of endpoint and query string. The access time of a file is its LRU position,
+    the modification time its age for the TTL.
+    """
+    cls_name = "Query_Cache"
+
+    def __init__(self, cache_dir: str = "cache", max_size_mb: float = 1024., ttl: float = None):
+        """
+        :param cache_dir: directory to store the responses in
+        :param max_size_mb: size limit of all cached responses, least recently used ones are evicted beyond
+        :param ttl: maximum age of a cached response in seconds (None: no expiry), e.g. for recent imagery
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size_mb * 1024 * 1024
+        self.ttl = ttl
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def get_key(service_endpoint: str, query_str: str):
+        """
+        Hash identifying a query on an endpoint.
+        :param service_endpoint: URL of the rasdaman endpoint
+        :param query_str: WCPS query
+        :return: hex-digest of the SHA1-hash
+        """
+        return hashlib.sha1("{0}\n{1}".format(service_endpoint, query_str).encode("utf-8")).hexdigest()
+
+    def get_path(self, key: str):
+        return os.path.join(self.cache_dir, "{0}.nc".format(key))
+
+    def get(self, key: str):
+        """
+        Look up a cached response.
+        :param key: cache key from get_key
+        :return: path to the NetCDF-file or None if not cached or expired
+        """
+        path = self.get_path(key)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+
+        now = time.time()
+        if self.ttl is not None and now - stat.st_mtime > self.ttl:
+            # another thread may be removing the same expired response
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+
+        # mark as recently used, unless it was evicted meanwhile
+        try:
+            os.utime(path, (now, stat.st_mtime))
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, key: str, content: bytes):
+        """
+        Store a response and evict old ones if the cache got too large.
+        :param key: cache key from get_key
+        :param content: NetCDF byte-encoded response
+        :return: path to the NetCDF-file
+        """
+        return self.put_stream(key, [content])
+
+    def put_stream(self, key: str, chunks):
+        """
+        Like put, but writes the response piece by piece, so it never has to be held in memory.
+        :param key: cache key from get_key
+        :param chunks: iterable of bytes, e.g. Response.iter_content
+        :return: path to the NetCDF-file
+        """
+        path = self.get_path(key)
+        tmp_path = "{0}.{1:d}.{2:d}.tmp".format(path, os.getpid(), threading.get_ident())
+        try:
+            with open(tmp_path, "wb") as f:
+                for chunk in chunks:
+                    f.write(chunk)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        self.evict(keep=path)
+        return path
+
+    def evict(self, keep: str = None):
+        """
+        Removes least recently used responses until the cache fits into its size limit.
+        :param keep: path that must not be removed (the response just added)
+        """
+        files = []
+        for path in glob.glob(os.path.join(self.cache_dir, "*.nc")):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_atime, stat.st_size, path))
+
+        total = sum(f[1] for f in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_size:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+
+class Query_Telemetry(object):
+    """
+    Structured per-query measurements: time-to-first-byte, transfer, decode and total time, bytes received versus
+    decoded bytes and cache hits. Records can be appended to a JSON-lines file and exported in Prometheus text format.
+    """
+    cls_name = "Query_Telemetry"
+
+    stages = ["ttfb", "transfer", "decode", "total"]
+    buckets = [0.01, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30., 60., 120., 300.]
+
+    def __init__(self, jsonl_file: str = None):
+        """
+        :param jsonl_file: file to append one JSON-record per query to (None: keep records in memory only)
+        """
+        self.jsonl_file = jsonl_file
+        self.records = []
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_coverages(query_str: str):
+        """
+        Names of the coverages a WCPS query reads from.
+        :param query_str: WCPS query
+        :return: list of coverage names
+        """
+        coverages = []
+        for names in re.findall(r"\$\w+\s+in\s+\(([^)]*)\)", query_str):
+            coverages += [name.strip() for name in names.split(",") if name.strip()]
+        return coverages
+
+    def record(self, query_str: str, **measurements):
+        """
+        Adds the measurements of one query.
+        :param query_str: WCPS query
+        :param measurements: ttfb, transfer, decode, total (seconds), bytes_wire, bytes_decoded, cache_hit
+        :return: the record (dictionary)
+        """
+        rec = {"timestamp": time.time(), "query_hash": hashlib.sha1(query_str.encode("utf-8")).hexdigest(),
+               "coverages": self.get_coverages(query_str)}
+        rec.update(measurements)
+
+        with self.lock:
+            self.records.append(rec)
+            if self.jsonl_file is not None:
+                with open(self.jsonl_file, "a") as f:
+                    f.write(json.dumps(rec) + "\n")
+
+        return rec
+
+    def summary(self, by_coverage: bool = False, percentiles=(50, 95, 99)):
+        """
+        Percentiles of the stage timings and throughput.
+        :param by_coverage: group the records by the coverages they read
+        :param percentiles: percentiles to compute
+        :return: pandas DataFrame with one row per group and stage
+        """
+        with self.lock:
+            records = list(self.records)
+
+        groups = {}
+        for rec in records:
+            keys = rec["coverages"] if by_coverage and rec["coverages"] else ["all"]
+            for key in keys:
+                groups.setdefault(key, []).append(rec)
+
+        rows = []
+        for key, recs in groups.items():
+            network = [r for r in recs if not r.get("cache_hit")]
+            values = {stage: [r[stage] for r in (recs if stage in ["decode", "total"] else network)
+                              if r.get(stage) is not None] for stage in self.stages}
+            values["throughput (MB/s)"] = [r["bytes_wire"] / r["transfer"] / (1024 * 1024) for r in network
+                                           if r.get("transfer") and r.get("bytes_wire")]
+            for stage, vals in values.items():
+                row = {"group": key, "stage": stage, "count": len(vals),
+                       "cache hit rate": np.mean([bool(r.get("cache_hit")) for r in recs])}
+                for q in percentiles:
+                    row["p{0:d}".format(q)] = np.percentile(vals, q) if vals else np.nan
+                rows.append(row)
+
+        return pd.DataFrame(rows)
+
+    def to_prometheus(self, prom_file: str):
+        """
+        Writes the records as Prometheus text exposition (histograms of the stage timings and byte counters).
+        :param prom_file: output file, e.g. for the node-exporter textfile collector
+        """
+        with self.lock:
+            records = list(self.records)
+
+        lines = ["# HELP rasdaman_query_seconds Duration of the stages of a rasdaman query.",
+                 "# TYPE rasdaman_query_seconds histogram"]
+        for stage in self.stages:
+            vals = np.array([r[stage] for r in records if r.get(stage) is not None])
+            for le in self.buckets:
+                lines.append('rasdaman_query_seconds_bucket{{stage="{0}",le="{1}"}} {2:d}'
+                             .format(stage, le, int(np.sum(vals <= le))))
+            lines.append('rasdaman_query_seconds_bucket{{stage="{0}",le="+Inf"}} {1:d}'.format(stage, len(vals)))
+            lines.append('rasdaman_query_seconds_sum{{stage="{0}"}} {1}'.format(stage, float(np.sum(vals))))
+            lines.append('rasdaman_query_seconds_count{{stage="{0}"}} {1:d}'.format(stage, len(vals)))
+
+        lines += ["# HELP rasdaman_query_bytes_total Bytes received from the server and decoded into datasets.",
+                  "# TYPE rasdaman_query_bytes_total counter"]
+        for kind in ["wire", "decoded"]:
+            total = sum(r.get("bytes_" + kind) or 0 for r in records)
+            lines.append('rasdaman_query_bytes_total{{kind="{0}"}} {1:d}'.format(kind, int(total)))
+
+        lines += ["# HELP rasdaman_query_cache_total Queries answered from the cache or the server.",
+                  "# TYPE rasdaman_query_cache_total counter"]
+        hits = sum(bool(r.get("cache_hit")) for r in records)
+        lines.append('rasdaman_query_cache_total{{result="hit"}} {0:d}'.format(hits))
+        lines.append('rasdaman_query_cache_total{{result="miss"}} {0:d}'.format(len(records) - hits))
+
+        tmp_file = prom_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_file, prom_file)
+
+
 class Rasdaman_Query(object):
     cls_name = "Rasdaman_Query"
 
-    def __init__(self, service_endpoint="http://zam10213.zam.kfa-juelich.de/rasdaman/ows"):
-
+    def __init__(self, service_endpoint="http://zam10213.zam.kfa-juelich.de/rasdaman/ows", cache_dir: str = "cache",
+                 cache_size_mb: float = 1024., cache_ttl: float = None, max_concurrency: int = 4,
+                 timeout: tuple = (10., 300.), retries: int = 3, backoff_factor: float = 1.,
+                 spool_dir: str = None, stream_chunk_mb: float = 8., telemetry_file: str = None):
+        """
+        :param service_endpoint: URL of the rasdaman endpoint
+        :param cache_dir: directory for cached query responses (None disables caching)
+        :param cache_size_mb: size limit of the cache
+        :param cache_ttl: maximum age of cached responses in seconds (None: no expiry)
+        :param max_concurrency: maximum number of queries (and pooled connections) in flight at once
+        :param timeout: (connect, read) timeout of a request in seconds
+        :param retries: number of retries on connection errors, timeouts and 5xx-responses
+        :param backoff_factor: retries wait backoff_factor * 2^(n-1) seconds
+        :param spool_dir: directory for streamed responses when caching is disabled (default: system temp-dir)
+        :param stream_chunk_mb: size of the pieces a streamed response is read in
+        :param telemetry_file: JSON-lines file to log the measurements of every query to (None: in memory only)
+        """
         self.service_endpoint = service_endpoint
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.session = self.create_session(max_concurrency, retries, backoff_factor)
         _ = self.check_endpoint()
         self.query_history = {}
         self.nquery = 0
+        self.lock = threading.Lock()
+        self.cache = Query_Cache(cache_dir, cache_size_mb, cache_ttl) if cache_dir is not None else None
+        self.spool_dir = spool_dir
+        self.stream_chunk_size = int(stream_chunk_mb * 1024 * 1024)
+        self.spool_files = []
+        self.telemetry = Query_Telemetry(telemetry_file)
+
+    @staticmethod
+    def create_session(pool_size: int, retries: int, backoff_factor: float):
+        """
+        Session with keep-alive connection pool and exponential backoff.
+        :param pool_size: number of connections kept open per host
+        :param retries: number of retries on connection errors, timeouts and 5xx-responses
+        :param backoff_factor: retries wait backoff_factor * 2^(n-1) seconds
+        :return: requests.Session
+        """
+        # WCPS queries are read-only, so retrying POST is safe
+        retry = Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=(500, 502, 503, 504),
+                      allowed_methods=None, raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+
+        return session
 
     def check_endpoint(self, wait_time: int = 10):
         """
@@ -39,7 +327,7 @@ class Rasdaman_Query(object):
         method = Rasdaman_Query.check_endpoint.__name__
 
         try:
-            _ = requests.get(self.service_endpoint, timeout=wait_time)
+            _ = self.session.get(self.service_endpoint, timeout=wait_time)
             print("%{0}: Selected service endpoint '{1}' reached successfully.".format(method, self.service_endpoint))
         except (requests.ConnectionError, requests.Timeout) as exception:
             print("%{0}: Service endpoint '{1}' could not be reached. Please check URL as well as internet connection."
@@ -47,10 +335,13 @@ class Rasdaman_Query(object):
 
         return True
 
-    def get_query(self, query_str: str):
+    def get_query(self, query_str: str, use_cache: bool = True, chunks=None):
         """
         Function returns a query as a netcdf byte-encoded response.
         :param query_str: WCPS query.
+        :param use_cache: look up and store the response in the query cache
+        :param chunks: dask chunks (e.g. {"ansi": 100} or "auto") to stream the response to disk and open it
+                       out-of-core. With None the response is decoded in memory.
         :turns xarray.Dataset
         """
         method = Rasdaman_Query.get_query.__name__
@@ -58,21 +349,65 @@ class Rasdaman_Query(object):
         assert isinstance(query_str, str), \
             "%{0}: Query must be a string-object, but is of type '{1}'.".format(method, type(query_str))
 
+        use_cache = use_cache and self.cache is not None
+        stream = chunks is not None
+
         try:
             time0 = time.time()
-            print("%{0}: Start query...".format(method))
-            query_response = requests.post(self.service_endpoint, data={'query': query_str})
-            query_response.raise_for_status()
-            # Convert bytes to file-like object
-            netcdf_file = io.BytesIO(query_response.content)
-            # Convert the netcdf_file like object to a xarray dataset.
-            ds = xr.open_dataset(netcdf_file)
+            ttfb, transfer, bytes_wire = None, None, None
+            cache_file = None
+            if use_cache:
+                key = self.cache.get_key(self.service_endpoint, query_str)
+                cache_file = self.cache.get(key)
+
+            if cache_file is not None:
+                print("%{0}: Found query in cache...".format(method))
+                cache_hit = True
+            else:
+                print("%{0}: Start query...".format(method))
+                cache_hit = False
+                # Always streamed, so the body is only downloaded inside the timed transfer window below
+                query_response = self.session.post(self.service_endpoint, data={'query': query_str},
+                                                   timeout=self.timeout, stream=True)
+                query_response.raise_for_status()
+                # time until the response headers arrived (server time plus latency)
+                ttfb = query_response.elapsed.total_seconds()
+                time1 = time.time()
+                if stream:
+                    # Spool the response to disk piece by piece, it is never held in memory as a whole
+                    counter = [0]
+                    content = self.count_bytes(query_response.iter_content(chunk_size=self.stream_chunk_size),
+                                               counter)
+                    cache_file = self.cache.put_stream(key, content) if use_cache else self.spool(content)
+                    bytes_wire = counter[0]
+                else:
+                    content = query_response.content
+                    bytes_wire = len(content)
+                    if use_cache:
+                        cache_file = self.cache.put(key, content)
+                transfer = time.time() - time1
+
+            time2 = time.time()
+            if cache_file is not None:
+                # Open lazily from the file, data is only read when accessed (chunk by chunk with dask)
+                ds = xr.open_dataset(cache_file, chunks=chunks)
+            else:
+                # Convert bytes to file-like object
+                netcdf_file = io.BytesIO(content)
+                # Convert the netcdf_file like object to a xarray dataset.
+                ds = xr.open_dataset(netcdf_file)
+            decode = time.time() - time2
             # track time and populate query history
             time_tot = time.time() - time0
+            self.telemetry.record(query_str, ttfb=ttfb, transfer=transfer, decode=decode, total=time_tot,
+                                  bytes_wire=bytes_wire, bytes_decoded=int(ds.nbytes), cache_hit=cache_hit)
             query_dict = {"query string": query_str, "loading time": time_tot,
-                          "size data (MB)": ds.nbytes / (1024 * 1024)}
-            self.query_history["query_{0:d}".format(self.nquery)] = query_dict
-            self.nquery += 1
+                          "size data (MB)": ds.nbytes / (1024 * 1024), "cache hit": cache_hit,
+                          "time to first byte": ttfb, "transfer time": transfer, "decode time": decode,
+                          "size response (MB)": bytes_wire / (1024 * 1024) if bytes_wire is not None else None}
+            with self.lock:
+                self.query_history["query_{0:d}".format(self.nquery)] = query_dict
+                self.nquery += 1
             print("%{0}: Data query took {1:5.2f} seconds.".format(method, time_tot))
         except HTTPError as err:
             print("%{0}: Query '{1}' failed. See raised HTTPError-message.".format(method, query_str))
@@ -83,6 +418,56 @@ class Rasdaman_Query(object):
 
         return ds
 
+    @staticmethod
+    def count_bytes(chunks, counter: list):
+        """
+        Passes through the pieces of a streamed response and adds up their size in counter[0].
+        """
+        for chunk in chunks:
+            counter[0] += len(chunk)
+            yield chunk
+
+    def spool(self, chunks):
+        """
+        Writes a streamed response to a temporary NetCDF-file which is removed by cleanup.
+        :param chunks: iterable of bytes, e.g. Response.iter_content
+        :return: path to the temporary file
+        """
+        fd, path = tempfile.mkstemp(suffix=".nc", dir=self.spool_dir)
+        with self.lock:
+            self.spool_files.append(path)
+        with os.fdopen(fd, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+
+        return path
+
+    def cleanup(self):
+        """
+        Removes the temporary files of streamed responses. Close the datasets opened from them first.
+        """
+        with self.lock:
+            spool_files, self.spool_files = self.spool_files, []
+        for path in spool_files:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def get_queries(self, query_list: list, use_cache: bool = True, chunks=None):
+        """
+        Runs several queries concurrently (at most max_concurrency at once), e.g. for the dates of a time series.
+        :param query_list: list of WCPS queries
+        :param use_cache: look up and store the responses in the query cache
+        :param chunks: dask chunks to stream the responses, see get_query
+        :return: generator of (index in query_list, xarray.Dataset) in order of completion
+        """
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            futures = {executor.submit(self.get_query, query_str, use_cache, chunks): i
+                       for i, query_str in enumerate(query_list)}
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+
     @staticmethod
     def one_ansi_to_datetime(one_ansi):
         """
@@ -112,6 +497,125 @@ class Rasdaman_Query(object):
 
 
 # Other methods for data processing (not directly related to rasdaman)
+class Quantile_Sketch(object):
+    """
+    Mergeable KLL-type quantile sketch. Values are kept in compactors of weight 2**h whose capacities shrink
+    geometrically with the level below the top one, so memory stays O(k) whatever the number of samples.
+    Sketches built on different chunks (e.g. dask blocks) can be merged into one.
+    """
+    cls_name = "Quantile_Sketch"
+
+    def __init__(self, k: int = 200, c: float = 2./3., seed=None):
+        """
+        :param k: capacity of the top compactor (rank error ~ 1.7/k)
+        :param c: capacity ratio between neighbouring compactors
+        :param seed: seed for the random compaction offsets
+        """
+        self.k, self.c = k, c
+        self.rng = np.random.default_rng(seed)
+        self.compactors = [np.empty(0)]
+        self.n = 0
+        self.min, self.max = np.inf, -np.inf
+
+    def capacity(self, level: int):
+        """
+        Number of values the compactor at the given level may hold.
+        """
+        depth = len(self.compactors) - level - 1
+        return max(int(np.ceil(self.k * self.c**depth)), 2)
+
+    def update(self, values):
+        """
+        Adds values to the sketch, NaNs are ignored.
+        :param values: array-like of values
+        :return: the sketch itself
+        """
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[~np.isnan(values)]
+        if values.size == 0:
+            return self
+
+        self.n += values.size
+        self.min, self.max = min(self.min, values.min()), max(self.max, values.max())
+        self.compactors[0] = np.concatenate([self.compactors[0], values])
+        self.compress()
+
+        return self
+
+    def merge(self, other):
+        """
+        Adds the content of another sketch.
+        :param other: Quantile_Sketch (e.g. built on another chunk)
+        :return: the sketch itself
+        """
+        while len(self.compactors) < len(other.compactors):
+            self.compactors.append(np.empty(0))
+        for level, items in enumerate(other.compactors):
+            self.compactors[level] = np.concatenate([self.compactors[level], items])
+
+        self.n += other.n
+        self.min, self.max = min(self.min, other.min), max(self.max, other.max)
+        self.compress()
+
+        return self
+
+    def compress(self):
+        """
+        Compacts every compactor above its capacity: sorts it and promotes every other value (random offset) to the
+        next level with twice the weight. An odd value out stays where it is.
+        """
+        level = 0
+        while level < len(self.compactors):
+            items = self.compactors[level]
+            if items.size > self.capacity(level):
+                if level + 1 == len(self.compactors):
+                    self.compactors.append(np.empty(0))
+                items = np.sort(items)
+                keep = items.size % 2
+                offset = self.rng.integers(2)
+                self.compactors[level + 1] = np.concatenate([self.compactors[level + 1],
+                                                             items[keep + offset::2]])
+                self.compactors[level] = items[:keep]
+            level += 1
+
+    def weighted_items(self):
+        """
+        Sorted values of the sketch and their rank-based CDF-values (0 for the minimum, 1 for the maximum).
+        """
+        if self.n == 0:
+            raise ValueError("%{0}: Sketch is empty.".format(self.cls_name))
+
+        items = np.concatenate(self.compactors)
+        weights = np.concatenate([np.full(items_l.size, 2.**level) for level, items_l in enumerate(self.compactors)])
+        order = np.argsort(items, kind="stable")
+        items, weights = items[order], weights[order]
+
+        # same convention as the exact CDF, p = rank/(n-1)
+        probs = (np.cumsum(weights) - weights) / max(self.n - 1, 1)
+        items = np.concatenate([[self.min], items, [self.max]])
+        probs = np.clip(np.concatenate([[0.], probs, [1.]]), 0., 1.)
+
+        return items, np.maximum.accumulate(probs)
+
+    def quantiles(self, probs):
+        """
+        Approximate quantiles.
+        :param probs: probabilities in [0, 1]
+        :return: values at the given probabilities
+        """
+        items, cdf = self.weighted_items()
+        return np.interp(probs, cdf, items)
+
+    def cdf(self, xin):
+        """
+        Approximate CDF-values.
+        :param xin: values to evaluate the CDF at
+        :return: CDF-values
+        """
+        items, cdf = self.weighted_items()
+        return np.interp(xin, items, cdf)
+
+
 def get_cdf_of_x(sample_in, prob_in):
     """
     Wrappper for interpolating CDF-value for given data
@@ -121,24 +625,72 @@ def get_cdf_of_x(sample_in, prob_in):
     return lambda xin: np.interp(xin, sample_in, prob_in)
 
 
-def get_cdf_func(data):
+def get_sketch(data, k: int = 200, seed=None):
+    """
+    Builds a quantile sketch over (chunked) data. For dask-backed data, one sketch is built per block and the
+    sketches are merged, so no block has to be loaded together with another one.
+    :param data: xarray DataArray, dask or numpy array
+    :param k: sketch size, see Quantile_Sketch
+    :param seed: seed for the random compaction offsets
+    :return: Quantile_Sketch
+    """
+    arr = getattr(data, "data", data)
+
+    if hasattr(arr, "to_delayed"):
+        import dask
+        block_sketch = dask.delayed(lambda block: Quantile_Sketch(k, seed=seed).update(block))
+        sketches = dask.compute(*[block_sketch(block) for block in arr.to_delayed().ravel()])
+    else:
+        sketches = [Quantile_Sketch(k, seed=seed).update(arr)]
+
+    sketch = Quantile_Sketch(k, seed=seed)
+    for other in sketches:
+        sketch.merge(other)
+
+    return sketch
+
+
+def get_cdf_func(data, method: str = "exact", nprobs: int = 1001, k: int = 200):
     """
-    Converts input xarray to pandas dataframe and sorts the data to obtain wrapper function for the data's CDF.
+    Derives a wrapper function for the data's CDF. The CDF is represented by its quantiles on a fixed probability
+    grid, so the returned function does not keep the data alive.
+    :param data: xarray DataArray, dask or numpy array (NaNs are ignored)
+    :param method: "exact": quantiles from partial sorts of the valid data (small samples are fully represented),
+                   "sketch": approximate quantiles from a mergeable sketch built chunk-wise (constant memory)
+    :param nprobs: number of points of the probability grid
+    :param k: sketch size for method "sketch"
+    :return: function returning the CDF-values of its input
     """
-    method = get_cdf_func.__name__
+    method_name = get_cdf_func.__name__
+
+    if method == "exact":
+        values = np.asarray(getattr(data, "values", data), dtype=np.float64).ravel()
+        values = values[~np.isnan(values)]
+        nvalid_nh = values.size
+    elif method == "sketch":
+        sketch = get_sketch(data, k)
+        nvalid_nh = sketch.n
+    else:
+        raise ValueError("%{0}: Unknown method '{1}', choose 'exact' or 'sketch'.".format(method_name, method))
 
-    df = pd.DataFrame({'time': data.coords["ansi"], 'data': data.values})
-    df = df.sort_values(by='data')
-    nvalid_nh = np.count_nonzero(~np.isnan(df['data'].values))
     if nvalid_nh < 500:
         if nvalid_nh == 0:
-            raise ValueError("%{0}: No data points could be extracted.".format(method))
+            raise ValueError("%{0}: No data points could be extracted.".format(method_name))
         else:
             print("%{0}: WARNING: Only {1:3d} data points extracted. Discrete CDF will be rather coarse..."
-                  .format(method, nvalid_nh))
+                  .format(method_name, nvalid_nh))
+
+    if method == "exact" and nvalid_nh <= nprobs:
+        # small samples: every value is a node of the discrete CDF (probability = rank/(n-1))
+        sample = np.sort(values)
+        p_data = 1. * np.arange(nvalid_nh) / max(nvalid_nh - 1, 1)
+        return get_cdf_of_x(sample, p_data)
 
-    df = df[:nvalid_nh]
-    # calculate the probability of the sorted sample values (=CDF functional values)
-    p_data = 1. * np.arange(nvalid_nh) / (nvalid_nh - 1)
+    p_data = np.linspace(0., 1., nprobs)
+    if method == "exact":
+        # np.quantile partitions around the requested ranks instead of sorting everything
+        sample = np.quantile(values, p_data)
+    else:
+        sample = sketch.quantiles(p_data)
 
-    return get_cdf_of_x(df['data'].values, p_data)
+    return get_cdf_of_x(sample, p_data)
@@ -0,0 +1,128 @@
+# SPDX-FileCopyrightText: 2022 Earth System Data Exploration (ESDE), Jülich Supercomputing Center (JSC)
+#
+# SPDX-License-Identifier: MIT
+
+"""
+Tests of Rasdaman_Query against a local stub WCPS server.
+"""
+
+import time
+import threading
+import http.server
+import numpy as np
+import xarray as xr
+import pytest
+import requests
+
+from query_utils import Rasdaman_Query
+
+PAYLOAD = xr.Dataset({"precip": (("ansi", "Lat", "Long"), np.random.rand(5, 4, 4))},
+                     coords={"ansi": np.arange(5), "Lat": np.arange(4.), "Long": np.arange(4.)}
+                     ).to_netcdf(format="NETCDF3_64BIT")
+
+
+class Stub_Handler(http.server.BaseHTTPRequestHandler):
+    """
+    Answers every POST with PAYLOAD after server.delay seconds, the first server.failures POSTs with 503.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+    def do_POST(self):
+        server = self.server
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+        with server.lock:
+            server.posts.append(time.time())
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+            fail = server.failures > 0
+            server.failures -= fail
+
+        try:
+            if fail:
+                self.send_response(503)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            time.sleep(server.delay)
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(PAYLOAD)))
+            self.end_headers()
+            self.wfile.write(PAYLOAD)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+
+@pytest.fixture
+def stub():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Stub_Handler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.posts, server.failures, server.delay = [], 0, 0.
+    server.in_flight, server.max_in_flight = 0, 0
+    server.url = "http://127.0.0.1:{0:d}/rasdaman/ows".format(server.server_address[1])
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_retries_503_with_backoff(stub):
+    stub.failures = 2
+    rq = Rasdaman_Query(stub.url, cache_dir=None, retries=3, backoff_factor=0.2)
+
+    ds = rq.get_query("for $c in (A) return 1")
+
+    assert ds["precip"].shape == (5, 4, 4)
+    assert len(stub.posts) == 3
+    # the first retry is immediate, the second waits backoff_factor * 2
+    assert stub.posts[2] - stub.posts[1] >= 0.35
+
+
+def test_read_timeout(stub):
+    stub.delay = 1.
+    rq = Rasdaman_Query(stub.url, cache_dir=None, timeout=(5., 0.2), retries=1, backoff_factor=0.)
+
+    start = time.time()
+    with pytest.raises((requests.Timeout, requests.ConnectionError)):
+        rq.get_query("for $c in (A) return 1")
+
+    assert time.time() - start < 1.
+    assert len(stub.posts) == 2
+
+
+def test_get_queries_concurrency(stub):
+    stub.delay = 0.2
+    rq = Rasdaman_Query(stub.url, cache_dir=None, max_concurrency=3)
+    queries = ["for $c in (A) return {0:d}".format(i) for i in range(8)]
+
+    indices = [i for i, ds in rq.get_queries(queries)]
+
+    assert sorted(indices) == list(range(len(queries)))
+    assert 1 < stub.max_in_flight <= 3
+
+
+def test_identical_query_hits_cache(stub, tmp_path):
+    rq = Rasdaman_Query(stub.url, cache_dir=str(tmp_path))
+    query = "for $c in (A) return 1"
+
+    first = rq.get_query(query)
+    second = rq.get_query(query)
+
+    assert len(stub.posts) == 1
+    assert [rec["cache_hit"] for rec in rq.telemetry.records] == [False, True]
+    xr.testing.assert_identical(first.load(), second.load())
@@ -1,26 +1,47 @@
+import json
 import pickle
 
 import requests
-import cv2
 import pandas as pd
 import rasterio
+from rasterio.io import MemoryFile
+from rasterio.features import shapes
 import numpy as np
-import subprocess
+from functools import lru_cache
+from pyproj import Transformer
+from scipy import ndimage
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
+from concurrent.futures import ThreadPoolExecutor
+from rasterio.transform import Affine
+import shapely.geometry
+import shapely.ops
+
+# Coordinate conversion, replaces one gdaltransform process per pixel
+@lru_cache(maxsize=None)
+def get_transformer(src_crs, dst_crs):
+    # Building a transformer is the expensive part, keep one per CRS pair
+    return Transformer.from_crs(src_crs, dst_crs, always_xy=True)
+
+def reproject(xs, ys, src_crs="EPSG:32631", dst_crs="EPSG:4326"):
+    # Whole coordinate arrays in one call, returns (x, y) i.e. (lon, lat) for EPSG:4326
+    return get_transformer(src_crs, dst_crs).transform(np.asarray(xs, dtype=np.float64), np.asarray(ys, dtype=np.float64))
 
 # Retrieve an image using rasdaman
 service_endpoint = "https://ows.rasdaman.org/rasdaman/ows"
 # Parameters
 threshold = 0.9
 output_format = "image/tiff"
-output_file = "query_result.tiff"
+# (connect, read) timeout in seconds, a stalled tile must not block extract_area forever
+timeout = (10, 300)
 
 # CRS: 32631
 # Sample: https://www.google.com/maps/@50.7240279,9.0168918,12z
-query = '''
+query_template = '''
 for $c in (S2_L2A_32631_B08_10m),
     $d in (S2_L2A_32631_B04_10m)
 
-let $cutOut := [ ansi( "2021-04-09" ), E( 670000:679000 ), N( 4990220:4993220 ) ]
+let $cutOut := [ ansi( "{date}" ), E( {e_min}:{e_max} ), N( {n_min}:{n_max} ) ]
 return
   encode( (
 
@@ -28,101 +49,242 @@ return
  ) * 255
 
   , "{outfrmt}")
-'''.format(thr=threshold, outfrmt=output_format)
-
-response = requests.post(service_endpoint, data = {'query': query}, verify=False)
-
-# Save the response to a picture
-print("Convert to tiff")
-with open(output_file, "wb") as f:
-    f.write(response.content)
-
-# Get the jpeg image
-# TODO: Retrieve the image in 4326 coordinates from the server
-# Link: https://doc.rasdaman.org/11_cheatsheets.html#coverage-operations (crsTransform)
-query2 = '''
-for $c in (S2_L2A_32631_B08_10m),
-    $d in (S2_L2A_32631_B04_10m)
-
-let $cutOut := [ ansi( "2021-04-09" ), E( 670000:679000 ), N( 4990220:4993220 ) ]
-return
-  encode( (
-
-      (((float) $c - $d) / ((float) $c + $d)) [ $cutOut ] > {thr}
- ) * 255
-
-  , "{outfrmt}")
-'''.format(thr=threshold, outfrmt="image/jpeg")
-
-response = requests.post(service_endpoint, data = {'query': query2}, verify=False)
-
-# Save the response to a picture
-print("Convert to jpeg")
-with open("query_result.jpeg", "wb") as f:
-    f.write(response.content)
-
-# Open the two files
-im = cv2.imread("query_result.jpeg", cv2.IMREAD_GRAYSCALE) # Machine Visio
-src = rasterio.open("query_result.tiff") # Coordinates
-
-# Converting image to a binary image
-# (black and white only image).
-_, matrix = cv2.threshold(im, 110, 255,
-                         cv2.THRESH_BINARY)
-
-data2 = np.where(matrix == 255)
-x2 = []
-y2 = []
-
-for i in range(data2[0].size):
-    x2.append(data2[0][i])
-    y2.append(data2[1][i])
-
-data3 = list(zip(x2, y2))
-
-pdData = pd.DataFrame(data3, columns =['x', 'y'])
-
-from sklearn.cluster import DBSCAN
-# cluster the data into five clusters
-dbscan = DBSCAN(eps = 8, min_samples = 4).fit(pdData) # fitting the model
-labels = dbscan.labels_ # getting the labels
-
-unique_labels = np.unique(labels)
-
-ourDict = {}
-
-for i in range(unique_labels.size):
-    ourDict[i] = {}
-    ourDict[i]["Centroid"] = pdData[labels == unique_labels[i]].mean(0)
-    ourDict[i]["Points"] = pdData[labels == unique_labels[i]]
-    # With coordinates
-    xs, ys = rasterio.transform.xy(src.transform, ourDict[i]["Centroid"][0], ourDict[i]["Centroid"][1])
-    xsP, ysP = rasterio.transform.xy(src.transform, ourDict[i]["Points"]["x"], ourDict[i]["Centroid"]["y"])
-
-    ourDict[i]["CentroidCoord"] = [xs, ys]
-
-    # Get the coordinates of the centroid
-    cent1 = ourDict[i]["CentroidCoord"][0]
-    cent2 = ourDict[i]["CentroidCoord"][1]
-
-    cmd = 'echo {} {} | gdaltransform -s_srs EPSG:32631 -t_srs EPSG:4326'.format(cent1, cent2)
-    out = subprocess.check_output(cmd, shell=True).decode(encoding="utf-8").split()
-
-    coordPoints = list(zip(xsP, ysP))
-    ourDict[i]["PointsCoord"] = coordPoints
-
-    coordPointsTrans = []
-
-    for j in range(coordPoints.__len__()):
-        cmd = 'echo {} {} | gdaltransform -s_srs EPSG:32631 -t_srs EPSG:4326'.format(coordPoints[j][0], coordPoints[j][1])
-        out = subprocess.check_output(cmd, shell=True).decode(encoding="utf-8").split()
-
-        coordPointsTrans.append([float(out[0]), float(out[1])])
-
-    ourDict[i]["CentroidCoordTrans"] = [float(out[0]), float(out[1])]
-    ourDict[i]["PointsCoordTrans"] = coordPointsTrans
-
-# Save the centroids and points to a pickle file
-with open('centroids_and_points.pkl', 'wb') as f:
-    pickle.dump(ourDict, f)
-
+'''
+
+def build_query(e_range=(670000, 679000), n_range=(4990220, 4993220), date="2021-04-09", thr=threshold):
+    return query_template.format(date=date, e_min=e_range[0], e_max=e_range[1], n_min=n_range[0], n_max=n_range[1],
+                                 thr=thr, outfrmt=output_format)
+
+query = build_query()
+
+def fetch_mask(query, endpoint=service_endpoint, timeout=timeout):
+    # One GeoTIFF request, decoded straight from memory: the pixels for the
+    # machine vision part and the affine transform for the coordinates
+    response = requests.post(endpoint, data = {'query': query}, verify=False, timeout=timeout)
+    response.raise_for_status()
+
+    with MemoryFile(response.content) as memfile:
+        with memfile.open() as dataset:
+            im = dataset.read(1)
+            transform = dataset.transform
+
+    return im, transform
+
+# Blob extraction on the raster grid
+def label_mask(mask, eps=8, min_samples=4):
+    # Connected-component labelling. Pixels closer than eps are linked by
+    # dilating with a disk of radius eps/2 first, like DBSCAN's neighbourhood,
+    # and components smaller than min_samples pixels are treated as noise.
+    if eps > 1:
+        r = int(np.ceil(eps / 2))
+        yy, xx = np.ogrid[-r:r + 1, -r:r + 1]
+        grown = ndimage.binary_dilation(mask, structure=xx * xx + yy * yy <= r * r)
+    else:
+        grown = mask
+
+    labels, _ = ndimage.label(grown, structure=np.ones((3, 3), dtype=bool))
+    labels[~mask] = 0
+
+    # Drop small components and renumber the rest 1..n
+    counts = np.bincount(labels.ravel())
+    counts[0] = 0
+    keep = counts >= min_samples
+    relabel = np.zeros(len(counts), dtype=np.int32)
+    relabel[keep] = np.arange(1, keep.sum() + 1)
+
+    return relabel[labels]
+
+def label_mask_dbscan(mask, eps=8, min_samples=4):
+    # Original point clustering, noise pixels get label 0
+    from sklearn.cluster import DBSCAN
+
+    rows, cols = np.nonzero(mask)
+    labels = np.zeros(mask.shape, dtype=np.int32)
+    labels[rows, cols] = DBSCAN(eps = eps, min_samples = min_samples).fit(np.column_stack((rows, cols))).labels_ + 1
+
+    return labels
+
+def blob_stats(rows, cols, ids):
+    # Per blob reductions over labelled pixels, ids must run from 1 to n
+    if ids.size == 0:
+        return {}
+
+    order = np.argsort(ids, kind="stable")
+    rows, cols, ids = rows[order], cols[order], ids[order]
+    starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]])
+
+    area = np.diff(np.r_[starts, ids.size])
+    row_mean = np.add.reduceat(rows, starts) / area
+    col_mean = np.add.reduceat(cols, starts) / area
+    row_min, row_max = np.minimum.reduceat(rows, starts), np.maximum.reduceat(rows, starts)
+    col_min, col_max = np.minimum.reduceat(cols, starts), np.maximum.reduceat(cols, starts)
+
+    pixel_rows = np.split(rows, starts[1:])
+    pixel_cols = np.split(cols, starts[1:])
+
+    blobs = {}
+    for k, i in enumerate(ids[starts].tolist()):
+        blobs[i] = {"Centroid": (row_mean[k], col_mean[k]),
+                    "Area": int(area[k]),
+                    "BBox": (int(row_min[k]), int(col_min[k]), int(row_max[k]) + 1, int(col_max[k]) + 1),
+                    "Pixels": (pixel_rows[k], pixel_cols[k])}
+
+    return blobs
+
+def extract_blobs(mask, eps=8, min_samples=4, method="label"):
+    # Label image and per blob centroid, pixel count, bounding box and pixel
+    # indices, all from vectorized reductions over the labels
+    if method == "dbscan":
+        labels = label_mask_dbscan(mask, eps, min_samples)
+    else:
+        labels = label_mask(mask, eps, min_samples)
+
+    rows, cols = np.nonzero(labels)
+
+    return labels, blob_stats(rows, cols, labels[rows, cols])
+
+# Large areas of interest, fetched and labelled tile by tile
+def tile_bounds(e_range, n_range, tile_size=10000, overlap=200):
+    # Tiles of tile_size metres that overlap their neighbours by overlap metres
+    e_starts = np.arange(e_range[0], e_range[1], tile_size - overlap)
+    n_starts = np.arange(n_range[0], n_range[1], tile_size - overlap)
+
+    return [((e, min(e + tile_size, e_range[1])), (n, min(n + tile_size, n_range[1])))
+            for n in n_starts[::-1] for e in e_starts
+            if e + overlap < e_range[1] or e == e_range[0]
+            if n + overlap < n_range[1] or n == n_range[0]]
+
+def extract_tile(bounds, date="2021-04-09", thr=threshold, eps=8, min_samples=4, method="label",
+                 endpoint=service_endpoint, timeout=timeout):
+    e_range, n_range = bounds
+    im, transform = fetch_mask(build_query(e_range, n_range, date, thr), endpoint, timeout)
+    labels, blobs = extract_blobs(im > 110, eps, min_samples, method)
+
+    return blobs, transform, im.shape
+
+def extract_area(e_range, n_range, date="2021-04-09", thr=threshold, tile_size=10000, overlap=200,
+                 max_workers=4, eps=8, min_samples=4, method="label", endpoint=service_endpoint, timeout=timeout):
+    """
+    Blobs over a large bounding box (EPSG:32631 metres), one consolidated set.
+    Tiles are fetched and labelled concurrently by max_workers threads, the
+    overlap must be at least eps pixels so border blobs share pixels.
+    Returns the blobs with pixel indices on the grid of the returned transform.
+    """
+    tiles = tile_bounds(e_range, n_range, tile_size, overlap)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        results = list(pool.map(lambda b: extract_tile(b, date, thr, eps, min_samples, method, endpoint, timeout), tiles))
+
+    # Common grid anchored at the north west corner of all tiles
+    res_x, res_y = results[0][1].a, -results[0][1].e
+    west = min(t.c for _, t, _ in results)
+    north = max(t.f for _, t, _ in results)
+    offsets = [(int(round((north - t.f) / res_y)), int(round((t.c - west) / res_x))) for _, t, _ in results]
+    width = max(col + shape[1] for (_, col), (_, _, shape) in zip(offsets, results))
+
+    # Every tile blob pixel as (global pixel key, tile blob uid)
+    keys, uids = [], []
+    n_uids = 0
+    for (row_off, col_off), (blobs, _, _) in zip(offsets, results):
+        for blob in blobs.values():
+            rows, cols = blob["Pixels"]
+            keys.append((rows + row_off).astype(np.int64) * width + cols + col_off)
+            uids.append(np.full(len(rows), n_uids))
+            n_uids += 1
+
+    transform = Affine(res_x, 0., west, 0., -res_y, north)
+    if n_uids == 0:
+        return {}, transform
+
+    keys, uids = np.concatenate(keys), np.concatenate(uids)
+
+    # Blobs of neighbouring tiles that share a pixel in the overlap are one blob
+    order = np.argsort(keys, kind="stable")
+    keys, uids = keys[order], uids[order]
+    same = keys[1:] == keys[:-1]
+    links = csr_matrix((np.ones(same.sum()), (uids[:-1][same], uids[1:][same])), shape=(n_uids, n_uids))
+    _, component = connected_components(links, directed=False)
+
+    # Each pixel once, labelled by its merged blob
+    first = np.r_[True, ~same]
+    keys, ids = keys[first], component[uids[first]] + 1
+
+    return blob_stats(keys // width, keys % width, ids), transform
+
+# Polygon output for glin.plotting.plot_polygons
+def simplify_tolerance(zoom, lat, factor=0.5):
+    # Half a screen pixel at the given web map zoom level, in metres
+    return factor * 156543.03392 * np.cos(np.radians(lat)) / 2 ** zoom
+
+def blob_polygon(blob, transform):
+    # Outline of the blob's pixels in map coordinates, from its bounding box window
+    r0, c0, r1, c1 = blob["BBox"]
+    rows, cols = blob["Pixels"]
+
+    window = np.zeros((r1 - r0, c1 - c0), dtype=np.uint8)
+    window[rows - r0, cols - c0] = 1
+
+    parts = [shapely.geometry.shape(geom) for geom, _ in
+             shapes(window, mask=window.astype(bool), transform=transform * Affine.translation(c0, r0))]
+
+    return shapely.ops.unary_union(parts)
+
+def blobs_to_geojson(blobs, transform, zoom=12, src_crs="EPSG:32631", precision=6):
+    """
+    Simplified polygons of all blobs as a GeoJSON FeatureCollection in EPSG:4326.
+    Feature ids are the blob ids, so scores can be matched on them in plot_polygons.
+    """
+    features = []
+    for i, blob in blobs.items():
+        geom = blob_polygon(blob, transform)
+
+        xs, ys = rasterio.transform.xy(transform, blob["Centroid"][0], blob["Centroid"][1])
+        lon, lat = reproject(xs, ys, src_crs)
+
+        # Simplify in metres, before leaving the projected CRS
+        geom = geom.simplify(simplify_tolerance(zoom, lat), preserve_topology=True)
+        geom = shapely.ops.transform(
+            lambda x, y: tuple(np.round(c, precision) for c in reproject(x, y, src_crs)), geom)
+
+        features.append({"type": "Feature", "id": str(i),
+                         "properties": {"id": i, "area": blob["Area"] * abs(transform.a * transform.e),
+                                        "centroid": [round(float(lon), precision), round(float(lat), precision)]},
+                         "geometry": shapely.geometry.mapping(geom)})
+
+    return {"type": "FeatureCollection", "features": features}
+
+def write_polygons(feature_collection, path):
+    # GeoJSON, or FlatGeobuf for a .fgb path (needs geopandas)
+    if path.endswith(".fgb"):
+        import geopandas as gpd
+        gdf = gpd.GeoDataFrame.from_features(feature_collection["features"], crs="EPSG:4326")
+        gdf.to_file(path, driver="FlatGeobuf")
+    else:
+        with open(path, "w") as f:
+            json.dump(feature_collection, f, separators=(",", ":"))
+
+if __name__ == "__main__":
+
+    print("Fetch NDVI mask")
+    blobs, transform = extract_area((670000, 679000), (4990220, 4993220), tile_size = 5000)
+    pixelArea = abs(transform.a * transform.e) # m2
+
+    ourDict = {}
+
+    for i, blob in blobs.items():
+        ourDict[i] = {}
+        ourDict[i]["Centroid"] = pd.Series(blob["Centroid"], index=['x', 'y'])
+        ourDict[i]["Area"] = blob["Area"] * pixelArea
+        ourDict[i]["BBox"] = blob["BBox"]
+        # With coordinates
+        xs, ys = rasterio.transform.xy(transform, blob["Centroid"][0], blob["Centroid"][1])
+        ourDict[i]["CentroidCoord"] = [xs, ys]
+
+        lon, lat = reproject(xs, ys)
+        ourDict[i]["CentroidCoordTrans"] = [float(lon), float(lat)]
+
+    # Save the centroids to a pickle file, the outlines go to GeoJSON
+    with open('centroids_and_points.pkl', 'wb') as f:
+        pickle.dump(ourDict, f)
+
+    write_polygons(blobs_to_geojson(blobs, transform, zoom = 12), 'blobs.geojson')
@@ -1,8 +1,13 @@
-__all__ = ["ranking", "routing","plotting"]
+__all__ = ["ranking", "routing","plotting","graph","multimodal","route_cache","pipeline","spatial"]
 
 from .ranking import *
 from .routing import *
 from .plotting import *
+from .graph import *
+from .multimodal import *
+from .route_cache import *
+from .spatial import *
+from .pipeline import *
 
 __version__ = "0.1"
 __author__ = "AbreuGroup Jacobs University Bremen"
\ No newline at end of file
@@ -0,0 +1,500 @@
+import os
+import json
+import uuid
+import heapq
+import shutil
+import hashlib
+import numpy as np
+from scipy.spatial import cKDTree
+
+__all__ = ["RoadGraph", "ContractionHierarchy", "dijkstra", "haversine"]
+
+# Compact road graph: node ids, coordinates and CSR adjacency in NumPy arrays
+# Saved as one .npy file per array inside a directory next to G_map.pickle.
+# The directory name is a symlink to a versioned directory that is written
+# completely before the link is swapped, see _publish_directory.
+
+GRAPH_ARRAYS = ["node_ids", "lat", "lon", "indptr", "indices", "weights"]
+CH_ARRAYS = ["rank", "up_indptr", "up_indices", "up_weights", "up_mids",
+             "down_indptr", "down_indices", "down_weights", "down_mids"]
+
+def dijkstra(indptr, indices, weights, source, targets=None, cutoff=None):
+    # Single-source search over CSR arrays. Stops once every target is
+    # settled or the frontier passes cutoff. Only touched nodes are stored,
+    # so a bounded search on a large graph stays small.
+
+    source = int(source)
+    remaining = set(int(t) for t in targets) if targets is not None else None
+
+    dist = {}
+    pred = {source: -1}
+    seen = {source: 0.}
+    heap = [(0., source)]
+
+    while heap:
+        d, u = heapq.heappop(heap)
+        if u in dist:
+            continue
+        if cutoff is not None and d > cutoff:
+            break
+
+        dist[u] = d
+        if remaining is not None:
+            remaining.discard(u)
+            if not remaining:
+                break
+
+        start, end = indptr[u], indptr[u+1]
+        for v, w in zip(indices[start:end].tolist(), weights[start:end].tolist()):
+            nd = d + w
+            if v not in dist and nd < seen.get(v, np.inf):
+                seen[v] = nd
+                pred[v] = u
+                heapq.heappush(heap, (nd, v))
+
+    return dist, pred
+
+def reconstruct_path(pred, target):
+
+    path = [int(target)]
+    while pred[path[-1]] != -1:
+        path.append(pred[path[-1]])
+
+    return path[::-1]
+
+def _publish_directory(tmp, path):
+    # Make path point to the finished directory tmp with one rename of a
+    # symlink, so readers see either the old or the new set of files, never
+    # a mix. The previous version is removed, processes that have its files
+    # mapped keep reading them.
+
+    link = tmp + ".link"
+    os.symlink(os.path.basename(tmp), link)
+
+    old = None
+    if os.path.islink(path):
+        old = os.path.realpath(path)
+    elif os.path.isdir(path):
+        # Directory written in place by an earlier version, moved aside once
+        old = "{}.{}".format(path, uuid.uuid4().hex)
+        os.rename(path, old)
+
+    os.replace(link, path)
+
+    if old is not None and old != os.path.realpath(tmp):
+        shutil.rmtree(old, ignore_errors=True)
+
+EARTH_RADIUS = 6371008.8 # m
+
+def haversine(lat1, lon1, lat2, lon2):
+    # Great circle distance in metres, vectorized over arrays
+
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(a, dtype=np.float64)) for a in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2-lat1)/2)**2 + np.cos(lat1)*np.cos(lat2)*np.sin((lon2-lon1)/2)**2
+
+    return 2*EARTH_RADIUS*np.arcsin(np.sqrt(a))
+
+def _unit_vectors(lats, lons):
+
+    lat = np.radians(np.asarray(lats, dtype=np.float64))
+    lon = np.radians(np.asarray(lons, dtype=np.float64))
+    cos_lat = np.cos(lat)
+
+    return np.column_stack((cos_lat*np.cos(lon), cos_lat*np.sin(lon), np.sin(lat)))
+
+def _to_csr(n, src, dst, *columns):
+    # Sort edge lists by source node and build the row pointer
+
+    src = np.asarray(src, dtype=np.int64)
+    order = np.argsort(src, kind="stable")
+    indptr = np.zeros(n+1, dtype=np.int64)
+    np.cumsum(np.bincount(src, minlength=n), out=indptr[1:])
+
+    return (indptr, np.asarray(dst, dtype=np.int64)[order]) + tuple(np.asarray(c)[order] for c in columns)
+
+class RoadGraph(object):
+
+    def __init__(self, node_ids, lat, lon, indptr, indices, weights):
+
+        self.node_ids = node_ids
+        self.lat = lat
+        self.lon = lon
+        self.indptr = indptr
+        self.indices = indices
+        self.weights = weights
+        self.hierarchy = None
+        self.meta = {}
+        self.path = None
+        self._tree = None
+        self._fingerprint = None
+
+    @classmethod
+    def from_networkx(cls, G, weight='length'):
+
+        node_ids = np.fromiter(G.nodes, dtype=np.int64, count=G.number_of_nodes())
+        index = {n: i for i, n in enumerate(node_ids.tolist())}
+
+        lat = np.array([G.nodes[n]['y'] for n in node_ids.tolist()], dtype=np.float64)
+        lon = np.array([G.nodes[n]['x'] for n in node_ids.tolist()], dtype=np.float64)
+
+        src, dst, w = [], [], []
+        for u, nbrs in G.adj.items():
+            for v, edges in nbrs.items():
+                # Parallel edges in the MultiDiGraph, keep the shortest one
+                src.append(index[u])
+                dst.append(index[v])
+                w.append(min(attr.get(weight, 1) for attr in edges.values()))
+
+        indptr, indices, weights = _to_csr(len(node_ids), src, dst, np.array(w, dtype=np.float64))
+
+        return cls(node_ids, lat, lon, indptr, indices, weights)
+
+    @classmethod
+    def load(cls, path, mmap_mode=None):
+        # With mmap_mode='r' the arrays stay in the page cache and are shared
+        # by every process that maps the same files
+
+        # Read one version even if the link is swapped meanwhile. Its
+        # directory can only vanish when a newer one is already in place.
+        while True:
+            version = os.path.realpath(path)
+            try:
+                return cls._load_directory(version, mmap_mode)
+            except FileNotFoundError:
+                if os.path.realpath(path) == version:
+                    raise
+
+    @classmethod
+    def _load_directory(cls, path, mmap_mode):
+
+        arrays = {name: np.load(os.path.join(path, name + ".npy"), mmap_mode=mmap_mode) for name in GRAPH_ARRAYS}
+        graph = cls(**arrays)
+        graph.path = path
+
+        if os.path.exists(os.path.join(path, "ch_rank.npy")):
+            graph.hierarchy = ContractionHierarchy.load(path, mmap_mode=mmap_mode)
+
+        try:
+            with open(os.path.join(path, "meta.json")) as f:
+                graph.meta = json.load(f)
+            graph._fingerprint = graph.meta.get("fingerprint")
+        except FileNotFoundError:
+            pass
+
+        return graph
+
+    def save(self, path, **meta):
+        # Written into a new directory next to path, meta.json last, then
+        # published in one step
+
+        path = os.path.abspath(path)
+        tmp = "{}.{}".format(path, uuid.uuid4().hex)
+        os.makedirs(tmp)
+
+        try:
+            for name in GRAPH_ARRAYS:
+                np.save(os.path.join(tmp, name + ".npy"), getattr(self, name))
+
+            if self.hierarchy is not None:
+                self.hierarchy.save(tmp)
+
+            self.meta.update(meta)
+            self.meta.update({"n_nodes": self.n_nodes, "n_edges": self.n_edges,
+                              "hierarchy": self.hierarchy is not None, "fingerprint": self.fingerprint})
+            with open(os.path.join(tmp, "meta.json"), "w") as f:
+                json.dump(self.meta, f)
+
+            _publish_directory(tmp, path)
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+
+    @property
+    def n_nodes(self):
+        return len(self.node_ids)
+
+    @property
+    def n_edges(self):
+        return len(self.indices)
+
+    @property
+    def nbytes(self):
+        total = sum(getattr(self, name).nbytes for name in GRAPH_ARRAYS)
+        if self.hierarchy is not None:
+            total += self.hierarchy.nbytes
+        return total
+
+    @property
+    def fingerprint(self):
+        # Content hash of the topology and lengths, identifies cached routes
+
+        if self._fingerprint is None:
+            h = hashlib.sha1()
+            for name in ["node_ids", "indptr", "indices", "weights"]:
+                h.update(np.ascontiguousarray(getattr(self, name)).data)
+            self._fingerprint = h.hexdigest()
+
+        return self._fingerprint
+
+    @property
+    def tree(self):
+        # KD-tree over the nodes on the unit sphere, built once per graph.
+        # Chord length is monotonic in great circle distance, so the nearest
+        # point in 3D is the nearest node on the globe.
+
+        if self._tree is None:
+            self._tree = cKDTree(_unit_vectors(self.lat, self.lon))
+
+        return self._tree
+
+    def nearest_nodes(self, lats, lons):
+        # Batched snapping of many (lat, lon) points to node indices
+
+        _, nodes = self.tree.query(_unit_vectors(lats, lons))
+
+        return nodes
+
+    def nearest_node(self, lat, lon):
+
+        return int(self.nearest_nodes([lat], [lon])[0])
+
+    def shortest_paths(self, source, targets=None, cutoff=None):
+
+        return dijkstra(self.indptr, self.indices, self.weights, source, targets, cutoff)
+
+    def shortest_path(self, source, target):
+        # Point-to-point query, uses the contraction hierarchy when available
+
+        if self.hierarchy is not None:
+            return self.hierarchy.query(source, target)
+
+        dist, pred = self.shortest_paths(source, [target])
+        if int(target) not in dist:
+            return np.inf, []
+
+        return dist[int(target)], reconstruct_path(pred, target)
+
+    def build_hierarchy(self, witness_limit=50):
+
+        self.hierarchy = ContractionHierarchy.build(self, witness_limit=witness_limit)
+        return self.hierarchy
+
+class ContractionHierarchy(object):
+    # Nodes are contracted in order of edge difference, adding shortcuts
+    # where no witness path exists. A query is a bidirectional Dijkstra that
+    # only walks towards higher ranked nodes, so it settles a few hundred
+    # nodes instead of the whole search ball.
+
+    def __init__(self, rank, up_indptr, up_indices, up_weights, up_mids,
+                 down_indptr, down_indices, down_weights, down_mids):
+
+        self.rank = rank
+        # Upward edges u -> v with rank[u] < rank[v], stored at u
+        self.up_indptr = up_indptr
+        self.up_indices = up_indices
+        self.up_weights = up_weights
+        self.up_mids = up_mids
+        # Downward edges u -> v with rank[u] > rank[v], stored reversed at v
+        self.down_indptr = down_indptr
+        self.down_indices = down_indices
+        self.down_weights = down_weights
+        self.down_mids = down_mids
+
+    @classmethod
+    def load(cls, path, mmap_mode=None):
+
+        return cls(**{name: np.load(os.path.join(path, "ch_" + name + ".npy"), mmap_mode=mmap_mode) for name in CH_ARRAYS})
+
+    def save(self, path):
+        # Into a directory that is not published yet, see RoadGraph.save
+
+        os.makedirs(path, exist_ok=True)
+        for name in CH_ARRAYS:
+            np.save(os.path.join(path, "ch_" + name + ".npy"), getattr(self, name))
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in CH_ARRAYS)
+
+    @classmethod
+    def build(cls, graph, witness_limit=50):
+
+        n = graph.n_nodes
+        out = [dict() for _ in range(n)]
+        inn = [dict() for _ in range(n)]
+        edges = {}
+
+        for u in range(n):
+            start, end = graph.indptr[u], graph.indptr[u+1]
+            for v, w in zip(graph.indices[start:end].tolist(), graph.weights[start:end].tolist()):
+                if u == v or w >= out[u].get(v, np.inf):
+                    continue
+                out[u][v] = w
+                inn[v][u] = w
+                edges[(u, v)] = (w, -1)
+
+        def witness(u, v, max_cost):
+            # Limited search from u in the remaining graph, skipping v
+            dist = {}
+            seen = {u: 0.}
+            heap = [(0., u)]
+            while heap and len(dist) < witness_limit:
+                d, x = heapq.heappop(heap)
+                if x in dist:
+                    continue
+                if d > max_cost:
+                    break
+                dist[x] = d
+                for y, w in out[x].items():
+                    if y == v:
+                        continue
+                    nd = d + w
+                    if nd < seen.get(y, np.inf):
+                        seen[y] = nd
+                        heapq.heappush(heap, (nd, y))
+            return seen
+
+        def shortcuts(v):
+            needed = []
+            if not out[v]:
+                return needed
+            max_out = max(out[v].values())
+            for u, w_in in inn[v].items():
+                seen = witness(u, v, w_in + max_out)
+                for x, w_out in out[v].items():
+                    if x == u:
+                        continue
+                    length = w_in + w_out
+                    if seen.get(x, np.inf) > length:
+                        needed.append((u, x, length))
+            return needed
+
+        deleted = np.zeros(n, dtype=np.int64)
+
+        def priority(v):
+            return len(shortcuts(v)) - len(inn[v]) - len(out[v]) + deleted[v]
+
+        heap = [(priority(v), v) for v in range(n)]
+        heapq.heapify(heap)
+
+        rank = np.empty(n, dtype=np.int64)
+        order = 0
+        while heap:
+            _, v = heapq.heappop(heap)
+
+            # Lazy update: re-evaluate and postpone if no longer the cheapest
+            p = priority(v)
+            if heap and p > heap[0][0]:
+                heapq.heappush(heap, (p, v))
+                continue
+
+            for u, x, length in shortcuts(v):
+                if length < out[u].get(x, np.inf):
+                    out[u][x] = length
+                    inn[x][u] = length
+                    edges[(u, x)] = (length, v)
+
+            for u in inn[v]:
+                del out[u][v]
+                deleted[u] += 1
+            for x in out[v]:
+                del inn[x][v]
+                deleted[x] += 1
+            out[v] = {}
+            inn[v] = {}
+
+            rank[v] = order
+            order += 1
+
+        src = np.array([e[0] for e in edges], dtype=np.int64)
+        dst = np.array([e[1] for e in edges], dtype=np.int64)
+        w = np.array([e[0] for e in edges.values()], dtype=np.float64)
+        mid = np.array([e[1] for e in edges.values()], dtype=np.int64)
+
+        up = rank[src] < rank[dst]
+        up_csr = _to_csr(n, src[up], dst[up], w[up], mid[up])
+        down_csr = _to_csr(n, dst[~up], src[~up], w[~up], mid[~up])
+
+        return cls(rank, *up_csr, *down_csr)
+
+    def query(self, source, target):
+
+        source, target = int(source), int(target)
+        if source == target:
+            return 0., [source]
+
+        sides = [(self.up_indptr, self.up_indices, self.up_weights),
+                 (self.down_indptr, self.down_indices, self.down_weights)]
+        dist = [{source: 0.}, {target: 0.}]
+        pred = [{source: -1}, {target: -1}]
+        settled = [set(), set()]
+        heaps = [[(0., source)], [(0., target)]]
+        best, meet = np.inf, -1
+
+        while heaps[0] or heaps[1]:
+            for side in (0, 1):
+                heap = heaps[side]
+                if not heap:
+                    continue
+                if heap[0][0] >= best:
+                    heap.clear()
+                    continue
+
+                d, u = heapq.heappop(heap)
+                if u in settled[side]:
+                    continue
+                settled[side].add(u)
+
+                other = dist[1-side].get(u)
+                if other is not None and d + other < best:
+                    best, meet = d + other, u
+
+                indptr, indices, weights = sides[side]
+                start, end = indptr[u], indptr[u+1]
+                for v, w in zip(indices[start:end].tolist(), weights[start:end].tolist()):
+                    nd = d + w
+                    if nd < dist[side].get(v, np.inf):
+                        dist[side][v] = nd
+                        pred[side][v] = u
+                        heapq.heappush(heap, (nd, v))
+
+        if meet < 0:
+            return np.inf, []
+
+        # Hierarchy path source -> meet -> target, then expand the shortcuts
+        hops = reconstruct_path(pred[0], meet)
+        node = meet
+        while pred[1][node] != -1:
+            node = pred[1][node]
+            hops.append(node)
+
+        path = [source]
+        for a, b in zip(hops[:-1], hops[1:]):
+            self._unpack(a, b, path)
+
+        return best, path
+
+    def _mid(self, a, b):
+        # Contracted node of edge a -> b, -1 for an original edge. Looked up
+        # in the (memory mapped) CSR row that stores the edge.
+
+        if self.rank[a] < self.rank[b]:
+            start, end = self.up_indptr[a], self.up_indptr[a+1]
+            k = np.flatnonzero(self.up_indices[start:end] == b)[0]
+            return int(self.up_mids[start + k])
+
+        start, end = self.down_indptr[b], self.down_indptr[b+1]
+        k = np.flatnonzero(self.down_indices[start:end] == a)[0]
+        return int(self.down_mids[start + k])
+
+    def _unpack(self, a, b, path):
+
+        stack = [(a, b)]
+        while stack:
+            a, b = stack.pop()
+            m = self._mid(a, b)
+            if m < 0:
+                path.append(b)
+            else:
+                stack.append((m, b))
+                stack.append((a, m))
@@ -0,0 +1,196 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+
+from .graph import dijkstra, reconstruct_path, haversine, _to_csr
+from .routing import get_graph, PLACE, NETWORK_TYPE
+
+__all__ = ["MultimodalGraph", "compute_multimodal_paths", "load_layers", "layer_from_networkx"]
+
+# Layered road + rail + air + port graph, see component2_Serhat/routes-procedures.txt
+#
+# Layer fixtures are JSON files of the form
+#   {"rail": {"nodes": [[id, lat, lon], ...], "edges": [[u, v, length_m], ...], "hubs": [id, ...]},
+#    "air":  {"nodes": [[id, lat, lon], ...]},
+#    "port": {"nodes": [...], "edges": [...]}}
+# Edges are undirected, a null length means great circle distance. Without
+# "edges" every pair of nodes is connected (flights). Without "hubs" every
+# node is a transfer point to the road layer.
+
+MODES = ["road", "rail", "air", "port"]
+
+# Cost per metre relative to road, from the upper bounds in ranking.carbon_footprint
+MODE_COSTS = {"road": 1.0, "rail": 100/150, "air": 500/150, "port": 40/150}
+
+# Loading and unloading, in metres of road driving
+TRANSFER_COSTS = {"rail": 10000., "air": 50000., "port": 20000.}
+
+def load_layers(path):
+
+    with open(path) as f:
+        return json.load(f)
+
+def layer_from_networkx(G, hubs=None, weight='length'):
+    # Layer dict from an osmnx graph, e.g. a rail network extracted with
+    # ox.graph_from_place(place, custom_filter='["railway"~"rail"]')
+
+    layer = {"nodes": [[n, d['y'], d['x']] for n, d in G.nodes(data=True)],
+             "edges": [[u, v, d.get(weight)] for u, v, d in G.edges(data=True)]}
+    if hubs is not None:
+        layer["hubs"] = list(hubs)
+
+    return layer
+
+class MultimodalGraph(object):
+    # Road nodes keep their RoadGraph indices, the other layers are appended
+    # after them. Transfer edges between hubs and their nearest road node are
+    # computed once here, so a request is one Dijkstra over all layers.
+
+    def __init__(self, road, layers, mode_costs=None, transfer_costs=None):
+
+        mode_costs = dict(MODE_COSTS, **(mode_costs or {}))
+        transfer_costs = dict(TRANSFER_COSTS, **(transfer_costs or {}))
+
+        self.road = road
+        self.labels = {}
+        lat, lon = [road.lat], [road.lon]
+
+        # Road layer straight from the CSR arrays
+        src = [np.repeat(np.arange(road.n_nodes), np.diff(road.indptr))]
+        dst = [np.asarray(road.indices)]
+        lengths = [np.asarray(road.weights, dtype=np.float64)]
+        costs = [lengths[0] * mode_costs["road"]]
+        modes = [np.zeros(road.n_edges, dtype=np.int8)]
+
+        n = road.n_nodes
+        for name in MODES[1:]:
+            if name not in layers:
+                continue
+            layer = layers[name]
+            mode = MODES.index(name)
+
+            ids = [node[0] for node in layer["nodes"]]
+            index = {node_id: n + i for i, node_id in enumerate(ids)}
+            layer_lat = np.array([node[1] for node in layer["nodes"]], dtype=np.float64)
+            layer_lon = np.array([node[2] for node in layer["nodes"]], dtype=np.float64)
+            for node_id, i in index.items():
+                self.labels[i] = "{}:{}".format(name, node_id)
+
+            if "edges" in layer:
+                u = np.array([index[e[0]] for e in layer["edges"]], dtype=np.int64)
+                v = np.array([index[e[1]] for e in layer["edges"]], dtype=np.int64)
+                length = np.array([np.nan if e[2] is None else e[2] for e in layer["edges"]], dtype=np.float64)
+            else:
+                u, v = np.triu_indices(len(ids), k=1)
+                u, v = u + n, v + n
+                length = np.full(len(u), np.nan)
+
+            missing = np.isnan(length)
+            length[missing] = haversine(layer_lat[u[missing]-n], layer_lon[u[missing]-n],
+                                        layer_lat[v[missing]-n], layer_lon[v[missing]-n])
+
+            # Undirected layer edges
+            src += [u, v]
+            dst += [v, u]
+            lengths += [length, length]
+            costs += [length * mode_costs[name]] * 2
+            modes += [np.full(len(u), mode, dtype=np.int8)] * 2
+
+            # Transfer edges hub <-> nearest road node, driven on the road
+            hubs = np.array([index[h] for h in layer.get("hubs", ids)], dtype=np.int64)
+            access_nodes = road.nearest_nodes(layer_lat[hubs-n], layer_lon[hubs-n])
+            access = haversine(layer_lat[hubs-n], layer_lon[hubs-n], road.lat[access_nodes], road.lon[access_nodes])
+            access_cost = access * mode_costs["road"] + transfer_costs[name] / 2
+
+            src += [hubs, access_nodes]
+            dst += [access_nodes, hubs]
+            lengths += [access, access]
+            costs += [access_cost, access_cost]
+            modes += [np.zeros(len(hubs), dtype=np.int8)] * 2
+
+            lat.append(layer_lat)
+            lon.append(layer_lon)
+            n += len(ids)
+
+        self.n_nodes = n
+        self.lat = np.concatenate(lat)
+        self.lon = np.concatenate(lon)
+        self.indptr, self.indices, self.lengths, self.costs, self.modes = _to_csr(
+            n, np.concatenate(src), np.concatenate(dst),
+            np.concatenate(lengths), np.concatenate(costs), np.concatenate(modes))
+
+    def label(self, node):
+        # OSM id for road nodes, "<layer>:<id>" for the others
+
+        if node < self.road.n_nodes:
+            return int(self.road.node_ids[node])
+        return self.labels[node]
+
+    def _edge(self, u, v):
+        # Cheapest edge u -> v, the one Dijkstra relaxed
+
+        start, end = self.indptr[u], self.indptr[u+1]
+        k = start + np.flatnonzero(self.indices[start:end] == v)
+        k = k[np.argmin(self.costs[k])]
+
+        return self.lengths[k], self.modes[k]
+
+    def shortest_paths(self, source, targets=None, cutoff=None):
+
+        return dijkstra(self.indptr, self.indices, self.costs, source, targets, cutoff)
+
+    def breakdown(self, path):
+        # Metres travelled per mode along a path
+
+        if len(path) < 2:
+            return np.zeros(len(MODES))
+
+        edges = [self._edge(u, v) for u, v in zip(path[:-1], path[1:])]
+        lengths = np.array([e[0] for e in edges], dtype=np.float64)
+        modes = np.array([e[1] for e in edges], dtype=np.int64)
+
+        return np.bincount(modes, weights=lengths, minlength=len(MODES))
+
+_GRAPHS = {}
+
+def get_multimodal_graph(layers_loc, place=PLACE, network_type=NETWORK_TYPE, mode_costs=None, transfer_costs=None):
+    # Built once per road graph, layer file version and cost setting
+
+    road = get_graph(place, network_type)
+    key = (os.path.abspath(layers_loc), os.path.getmtime(layers_loc), road.fingerprint, place, network_type,
+           tuple(sorted((mode_costs or {}).items())), tuple(sorted((transfer_costs or {}).items())))
+
+    if key not in _GRAPHS:
+        _GRAPHS[key] = MultimodalGraph(road, load_layers(layers_loc), mode_costs, transfer_costs)
+
+    return _GRAPHS[key]
+
+def compute_multimodal_paths(origin, endpoints, layers_loc, max_cost=None, mode_costs=None, transfer_costs=None,
+                             place=PLACE, network_type=NETWORK_TYPE):
+    # Same layout as routing.compute_paths, with the rail, air and port legs filled in
+    # max_cost: cutoff on the combined cost, in Km of road driving
+
+    graph = get_multimodal_graph(layers_loc, place, network_type, mode_costs, transfer_costs)
+
+    blob_ids = list(endpoints.keys())
+    points = np.array([origin] + [endpoints[i] for i in blob_ids], dtype=np.float64).reshape(-1, 2)
+
+    # Start and end on the road layer
+    nodes = graph.road.nearest_nodes(points[:, 0], points[:, 1])
+    source, targets = nodes[0], nodes[1:].tolist()
+
+    cutoff = max_cost*1000 if max_cost is not None else None # Km to m
+    costs, pred = graph.shortest_paths(source, targets, cutoff=cutoff)
+
+    rows = []
+    for blob_id, target in zip(blob_ids, targets):
+        if target not in costs:
+            continue
+        path = reconstruct_path(pred, target)
+        road, rail, air, port = graph.breakdown(path)/1000 # m to Km
+        route = [graph.label(node) for node in path]
+        rows.append([blob_id, len(rows)+1, road+rail+air+port, rail, road, port, air, route])
+
+    return pd.DataFrame(rows,
+    columns =['BlobId', 'RouteId', 'TotalDistance','RailDistance', 'RoadDistance','PortDistance','AirDistance','Route'])
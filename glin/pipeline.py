@@ -0,0 +1,299 @@
+import os
+import sys
+import time
+import pickle
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+import osmnx as ox
+
+from .routing import compute_paths
+from .ranking import do_preprocesing, calculate_score
+from .plotting import plot_polygons
+from .spatial import BlobIndex
+
+__all__ = ["Stage", "Pipeline", "content_hash", "make_pipeline"]
+
+# Address to ranked polygons as a DAG of stages. Every stage result is
+# memoized under a hash of the stage and its inputs. Stage outputs are not
+# hashed themselves: their hash derives from the key of the stage that made
+# them, so a changed parameter only invalidates the stages downstream of it.
+
+def content_hash(value):
+
+    h = hashlib.sha1()
+    _update_hash(h, value)
+    return h.hexdigest()
+
+def _update_hash(h, value):
+
+    h.update(type(value).__name__.encode())
+
+    if value is None or isinstance(value, (bool, int, float, complex, np.generic)):
+        h.update(repr(value).encode())
+    elif isinstance(value, str):
+        h.update(value.encode("utf-8"))
+    elif isinstance(value, bytes):
+        h.update(value)
+    elif isinstance(value, np.ndarray) and value.dtype != object:
+        h.update("{}{}".format(value.dtype, value.shape).encode())
+        h.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, (pd.DataFrame, pd.Series)):
+        try:
+            h.update(pd.util.hash_pandas_object(value, index=True).values.tobytes())
+            h.update(repr(list(getattr(value, "columns", [value.name]))).encode())
+        except TypeError:
+            # Unhashable cells, e.g. the node lists of routes
+            h.update(pickle.dumps(value))
+    elif isinstance(value, dict):
+        for key in sorted(value, key=repr):
+            _update_hash(h, key)
+            _update_hash(h, value[key])
+    elif isinstance(value, (list, tuple)):
+        h.update(str(len(value)).encode())
+        for item in value:
+            _update_hash(h, item)
+    else:
+        h.update(pickle.dumps(value))
+
+class Stage(object):
+    # inputs and outputs map names to types, None accepts anything. fn is
+    # called with the inputs as keyword arguments and returns a dict of the
+    # outputs, or the value itself for a single output. Bump version when fn
+    # changes so memoized results are not reused.
+
+    def __init__(self, name, fn, inputs, outputs, version=1):
+
+        self.name = name
+        self.fn = fn
+        self.inputs = dict(inputs)
+        self.outputs = dict(outputs)
+        self.version = version
+
+    def check(self, kind, values, types):
+
+        for name, expected in types.items():
+            if expected is not None and not isinstance(values[name], expected):
+                raise TypeError("Stage '{}': {} '{}' must be {}, got {}".format(
+                    self.name, kind, name, expected, type(values[name]).__name__))
+
+    def __call__(self, **inputs):
+
+        self.check("input", inputs, self.inputs)
+
+        result = self.fn(**inputs)
+        if len(self.outputs) == 1 and not (isinstance(result, dict) and set(result) == set(self.outputs)):
+            result = {next(iter(self.outputs)): result}
+
+        missing = set(self.outputs) - set(result)
+        if missing:
+            raise ValueError("Stage '{}' did not return {}".format(self.name, sorted(missing)))
+        self.check("output", result, self.outputs)
+
+        return result
+
+    def __repr__(self):
+        return "Stage({}: {} -> {})".format(self.name, list(self.inputs), list(self.outputs))
+
+class Pipeline(object):
+
+    def __init__(self, stages, max_entries=256):
+
+        self.stages = {}
+        self.producer = {}
+        for stage in stages:
+            if stage.name in self.stages:
+                raise ValueError("Duplicate stage '{}'".format(stage.name))
+            self.stages[stage.name] = stage
+            for output in stage.outputs:
+                if output in self.producer:
+                    raise ValueError("'{}' is produced by both '{}' and '{}'".format(
+                        output, self.producer[output], stage.name))
+                self.producer[output] = stage.name
+
+        self.order = self._sort()
+        self.params = sorted({name for stage in self.stages.values() for name in stage.inputs} - set(self.producer))
+
+        self.max_entries = max_entries
+        self._memo = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.timings = {}
+        self.stats = {name: {"runs": 0, "hits": 0, "seconds": 0.} for name in self.stages}
+
+    def _sort(self):
+        # Topological order of the stages, inputs nobody produces are parameters
+
+        order, state = [], {}
+
+        def visit(name, chain):
+            if state.get(name) == "done":
+                return
+            if state.get(name) == "visiting":
+                raise ValueError("Cycle in pipeline: {}".format(" -> ".join(chain + [name])))
+            state[name] = "visiting"
+            for value in self.stages[name].inputs:
+                if value in self.producer:
+                    visit(self.producer[value], chain + [name])
+            state[name] = "done"
+            order.append(name)
+
+        for name in self.stages:
+            visit(name, [])
+
+        return order
+
+    def upstream(self, targets):
+        # Stages needed for the target values, in execution order
+
+        needed, todo = set(), list(targets)
+        while todo:
+            value = todo.pop()
+            if value in self.producer and self.producer[value] not in needed:
+                needed.add(self.producer[value])
+                todo += list(self.stages[self.producer[value]].inputs)
+
+        return [name for name in self.order if name in needed]
+
+    def run(self, params, targets=None):
+        # All values computed for the targets (default: every stage output),
+        # timings of this run in self.timings
+
+        targets = list(targets) if targets is not None else list(self.producer)
+        stages = self.upstream(targets)
+
+        values = dict(params)
+        hashes = {name: content_hash(value) for name, value in params.items()}
+        self.timings = {}
+
+        for name in stages:
+            stage = self.stages[name]
+            missing = [value for value in stage.inputs if value not in values]
+            if missing:
+                raise KeyError("Stage '{}' needs parameters {}".format(name, missing))
+
+            key = content_hash([name, stage.version] + [[value, hashes[value]] for value in sorted(stage.inputs)])
+
+            start = time.perf_counter()
+            with self._lock:
+                outputs = self._memo.get(key)
+                if outputs is not None:
+                    self._memo.move_to_end(key)
+
+            cached = outputs is not None
+            if not cached:
+                outputs = stage(**{value: values[value] for value in stage.inputs})
+                with self._lock:
+                    self._memo[key] = outputs
+                    while len(self._memo) > self.max_entries:
+                        self._memo.popitem(last=False)
+
+            seconds = time.perf_counter() - start
+            self.timings[name] = {"seconds": seconds, "cached": cached}
+            self.stats[name]["hits" if cached else "runs"] += 1
+            self.stats[name]["seconds"] += seconds
+
+            for value, result in outputs.items():
+                values[value] = result
+                hashes[value] = content_hash([key, value])
+
+        return values
+
+    def timing_table(self):
+        # Last run and cumulative per stage figures
+
+        rows = [dict(stage=name, **self.timings.get(name, {"seconds": np.nan, "cached": None}),
+                     **{"total_" + k: v for k, v in self.stats[name].items()}) for name in self.order]
+        return pd.DataFrame(rows).set_index("stage")
+
+    def clear(self):
+
+        with self._lock:
+            self._memo.clear()
+
+# The glin stages
+
+def _retrieve_points():
+    # Blob extraction lives in the Retrieve_Points scripts next to the package
+
+    try:
+        import full_implementation
+    except ImportError:
+        sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Retrieve_Points"))
+        import full_implementation
+
+    return full_implementation
+
+def geocode_address(address):
+
+    lat, lon = ox.geocode(address)
+    return (float(lat), float(lon))
+
+def extract_blobs(e_range, n_range, date):
+
+    blobs, transform = _retrieve_points().extract_area(tuple(e_range), tuple(n_range), date)
+    return {"blobs": blobs, "transform": transform}
+
+def blob_polygons(blobs, transform):
+
+    return _retrieve_points().blobs_to_geojson(blobs, transform)
+
+def index_blobs(polygons):
+
+    return BlobIndex.from_geojson(polygons)
+
+def select_candidates(index, center, size, radius):
+    # Centroids of the blobs of at least size Km2 within radius Km of the
+    # center, {BlobId: (lat, lon)}. Only these are routed.
+
+    return index.candidates(center, radius, size)
+
+def route_candidates(center, candidates, radius):
+
+    return compute_paths(center, candidates, radius)
+
+def rank_routes(routes, weights):
+
+    ranked = do_preprocesing(routes.copy())
+    if len(ranked):
+        calculate_score(ranked, weights)
+    else:
+        ranked["Score"] = pd.Series(dtype=np.float64)
+
+    return ranked
+
+def plot_ranked(polygons, ranked, center, zoom=8):
+
+    # Best route per blob
+    best = ranked.sort_values("Score").drop_duplicates("BlobId", keep="last")
+    scores = pd.DataFrame({"id": best["BlobId"].astype(str), "score": best["Score"]})
+
+    return plot_polygons(polygons, scores, center[0], center[1], zoom=zoom)
+
+DEFAULT_WEIGHTS = {"TotalDistance": -1., "UpperCarbonApprox": -1., "TimeApprox": -1.}
+
+def make_pipeline(geocode=geocode_address, extract=extract_blobs, polygons=blob_polygons, max_entries=256):
+    """
+    Address to plot: geocode -> extract -> polygons -> index -> candidates -> route -> rank -> plot.
+    Parameters: address, e_range, n_range, date, size (Km2), radius (Km) and weights
+    (column -> weight for ranking.calculate_score, e.g. DEFAULT_WEIGHTS).
+    The geocode, extract and polygons functions can be replaced, e.g. to reuse a stored extraction.
+    """
+    stages = [
+        Stage("geocode", geocode, {"address": str}, {"center": tuple}),
+        Stage("extract", extract, {"e_range": None, "n_range": None, "date": str},
+              {"blobs": dict, "transform": None}),
+        Stage("polygons", polygons, {"blobs": dict, "transform": None}, {"polygons": dict}),
+        Stage("index", index_blobs, {"polygons": dict}, {"index": BlobIndex}),
+        Stage("candidates", select_candidates,
+              {"index": BlobIndex, "center": tuple, "size": (int, float), "radius": (int, float)}, {"candidates": dict}),
+        Stage("route", route_candidates, {"center": tuple, "candidates": dict, "radius": (int, float)},
+              {"routes": pd.DataFrame}),
+        Stage("rank", rank_routes, {"routes": pd.DataFrame, "weights": dict}, {"ranked": pd.DataFrame}),
+        Stage("plot", plot_ranked, {"polygons": dict, "ranked": pd.DataFrame, "center": tuple}, {"figure": str}),
+    ]
+
+    return Pipeline(stages, max_entries=max_entries)
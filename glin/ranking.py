@@ -3,7 +3,7 @@ import numpy as np
 
 import random
 
-__all__ = ["do_preprocesing","calculate_score"]
+__all__ = ["do_preprocesing","calculate_score","score_routes","top_k","best_routes","RankingSession","rank_dataset"]
 
 # Preprocessing to generate additional datapoints
 
@@ -20,23 +20,81 @@ def carbon_footprint(df):
 def approximate_time(df):
     return df['TotalDistance'].values/60
 
+DISTANCES = ["TotalDistance","AirDistance","RoadDistance","RailDistance","PortDistance"]
+CARBON = ["UpperCarbonApprox","LowerCarbonApprox"]
+
+def normalization_scales(df, columns):
+    # Divisor per column: distances by the longest route, carbon by the
+    # largest upper bound, everything else is left as is
+
+    maxDist = df["TotalDistance"].max() if any(col in DISTANCES for col in columns) else 1.
+    maxCarb = df["UpperCarbonApprox"].max() if any(col in CARBON for col in columns) else 1.
+
+    return scales_from_maxima(columns, maxDist, maxCarb)
+
+def scales_from_maxima(columns, maxDist, maxCarb):
+
+    scales = np.ones(len(columns))
+    for i, col in enumerate(columns):
+        if col in DISTANCES:
+            scales[i] = maxDist
+        elif col in CARBON:
+            scales[i] = maxCarb
+
+    # Avoid dividing by zero on an all zero column
+    scales[scales == 0] = 1.
+
+    return scales
+
 def normalize_values(df):
 
     n_df = df.copy(deep=True)
 
-    # Normalization by maximum
-    maxDist = n_df["TotalDistance"].max()
-    distances = ["TotalDistance","AirDistance","RoadDistance","RailDistance","PortDistance"]
+    columns = DISTANCES + CARBON
+    n_df[columns] = n_df[columns]/normalization_scales(n_df, columns)
+
+    return n_df
 
-    for col in distances:
-        n_df[col] = n_df[col]/maxDist
+def score_columns(df, columns, weights, out=None):
+    # Weighted sum accumulated column by column. Float columns are read in
+    # place, no feature matrix is built; only bool columns are converted.
 
-    # Normalization by maximum
-    maxCarb = n_df["UpperCarbonApprox"]
-    n_df["UpperCarbonApprox"] = n_df["UpperCarbonApprox"]/maxCarb
-    n_df["LowerCarbonApprox"] = n_df["LowerCarbonApprox"]/maxCarb
+    out = np.zeros(len(df)) if out is None else out
+    out.fill(0.)
+    scratch = np.empty(len(df))
+    for col, w in zip(columns, weights):
+        if w == 0:
+            continue
+        np.multiply(df[col].to_numpy(dtype=np.float64), w, out=scratch)
+        out += scratch
 
-    return n_df
+    return out
+
+def score_routes(features, weights, out=None):
+    # One matrix-vector product over an already built feature matrix, e.g.
+    # the normalized RankingSession.features. Nothing is rescaled or copied here.
+
+    return np.dot(features, weights, out=out)
+
+def top_k(scores, k, largest=True):
+    # Indices of the k best scores, best first, without sorting everything
+
+    scores = np.asarray(scores)
+    k = min(max(k, 0), len(scores))
+    if k == 0:
+        return np.empty(0, dtype=np.int64)
+
+    # Partition from the top instead of negating, saves a full pass
+    if largest:
+        idx = np.argpartition(scores, len(scores)-k)[len(scores)-k:]
+        return idx[np.argsort(-scores[idx], kind="stable")]
+
+    idx = np.argpartition(scores, k-1)[:k]
+    return idx[np.argsort(scores[idx], kind="stable")]
+
+def best_routes(df, k, largest=True):
+
+    return df.iloc[top_k(df["Score"].values, k, largest)]
 
 def do_preprocesing(df):
 
@@ -58,12 +116,105 @@ def do_preprocesing(df):
 # Inplace score calculation
 def calculate_score(df, weights):
 
-    score_df = pd.DataFrame()
+    columns = list(weights.keys())
 
     # Make values are within 0 and 1
-    n_df = normalize_values(df)
+    w = np.array([weights[col] for col in columns], dtype=np.float64)/normalization_scales(df, columns)
+
+    df["Score"] = score_columns(df, columns, w)
+
+FEATURES = DISTANCES + CARBON + ["TimeApprox","UsesRail","UsesAir","UsesPort"]
+
+class RankingSession(object):
+    # Preprocessed and normalized features of one route set, kept between
+    # weight changes so re-ranking is only the weighted sum and a top-k
+
+    def __init__(self, df, columns=FEATURES):
+
+        if "TimeApprox" not in df:
+            df = do_preprocesing(df)
+
+        self.df = df
+        self.columns = list(columns)
+        self._index = {col: i for i, col in enumerate(self.columns)}
+
+        # Column major, every feature is one contiguous vector
+        self.features = np.asfortranarray(df[self.columns].to_numpy(dtype=np.float64))
+        self.features /= normalization_scales(df, self.columns)
+
+        self._scores = np.empty(len(df))
+
+    def scores(self, weights):
+        # One matrix-vector product over the columns with a non zero weight
+
+        w = np.zeros(len(self.columns))
+        for col, weight in weights.items():
+            if weight == 0:
+                continue
+            if col not in self._index:
+                raise KeyError("Column '{}' is not part of this ranking session".format(col))
+            w[self._index[col]] = weight
+
+        used = np.flatnonzero(w)
+        features = self.features if len(used) == len(w) else self.features[:, used]
+
+        return score_routes(features, w[used], out=self._scores)
+
+    def rank(self, weights, k=10, largest=True):
+        # Positions and scores of the k best routes, best first
+
+        scores = self.scores(weights)
+        idx = top_k(scores, k, largest)
+
+        return idx, scores[idx]
+
+    def top(self, weights, k=10, largest=True):
+
+        idx, scores = self.rank(weights, k, largest)
+        top_df = self.df.iloc[idx].copy()
+        top_df["Score"] = scores
+
+        return top_df
+
+# Route tables larger than memory, read batch by batch with pyarrow
+
+RAW_COLUMNS = ["TotalDistance","AirDistance","RoadDistance","RailDistance","PortDistance"]
+
+def _batches(source, columns=None, batch_size=1<<20):
+
+    import pyarrow.dataset as pds
+
+    fmt = "parquet"
+    paths = [source] if isinstance(source, str) else list(source)
+    if all(p.endswith((".arrow", ".feather", ".ipc")) for p in paths):
+        fmt = "ipc"
+
+    for batch in pds.dataset(paths, format=fmt).to_batches(columns=columns, batch_size=batch_size):
+        yield batch.to_pandas()
+
+def rank_dataset(source, weights, k=10, largest=True, batch_size=1<<20):
+    # source: Parquet or Arrow IPC file(s) with the compute_paths columns
+    # First pass finds the global maxima used for normalization, the second
+    # scores every batch and keeps only the running k best rows
+
+    maxDist, maxCarb = 0., 0.
+    for df in _batches(source, RAW_COLUMNS, batch_size):
+        lowerBound, upperBound = carbon_footprint(df)
+        maxDist = max(maxDist, df["TotalDistance"].max())
+        maxCarb = max(maxCarb, np.max(upperBound))
+
+    columns = list(weights.keys())
+    w = np.array([weights[col] for col in columns], dtype=np.float64)/scales_from_maxima(columns, maxDist, maxCarb)
+
+    best = None
+    for df in _batches(source, batch_size=batch_size):
+        do_preprocesing(df)
+        df["Score"] = score_columns(df, columns, w)
 
-    for col in weights.keys():
-        score_df[col] = n_df[col] * weights[col]
+        # Merge the batch's k best with the running k best, never more than 2k rows
+        candidates = best_routes(df, k, largest)
+        if best is not None:
+            candidates = pd.concat([best, candidates], ignore_index=True)
+        best = best_routes(candidates, k, largest).reset_index(drop=True)
 
-    df["Score"] = score_df.sum(1)
+    return best
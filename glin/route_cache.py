@@ -0,0 +1,101 @@
+import os
+import time
+import zlib
+import sqlite3
+import threading
+import numpy as np
+
+__all__ = ["RouteCache"]
+
+ROUTE_CACHE_LOC = os.getenv("GLIN_ROUTE_CACHE", "route_cache.sqlite")
+
+def encode_path(path):
+    # Delta encoded OSM ids compress well, consecutive nodes have close ids
+
+    path = np.asarray(path, dtype=np.int64)
+    return zlib.compress(np.diff(path, prepend=0).tobytes())
+
+def decode_path(blob):
+
+    return np.cumsum(np.frombuffer(zlib.decompress(blob), dtype=np.int64)).tolist()
+
+class RouteCache(object):
+    # Persistent (graph fingerprint, source, target) -> (length, path) store,
+    # shared by all graphs and processes. Rows of a rebuilt graph are never
+    # looked up again, they age out with the least recently used rows once
+    # max_entries is passed.
+
+    def __init__(self, path=ROUTE_CACHE_LOC, max_entries=1000000):
+
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+
+        with self._lock, self._db:
+            self._db.execute("""CREATE TABLE IF NOT EXISTS routes (
+                fingerprint TEXT, source INTEGER, target INTEGER,
+                length REAL, path BLOB, last_used REAL,
+                PRIMARY KEY (fingerprint, source, target))""")
+            self._db.execute("CREATE INDEX IF NOT EXISTS routes_last_used ON routes (last_used)")
+            # Running row count, other processes writing the same file make
+            # it drift, so it is recounted before evicting
+            self._count = self._db.execute("SELECT COUNT(*) FROM routes").fetchone()[0]
+
+    def get_many(self, fingerprint, source, targets):
+        # {target: (length, path)} for the targets that are cached
+
+        targets = [int(t) for t in targets]
+        found = {}
+
+        with self._lock, self._db:
+            # Stay below SQLite's host parameter limit
+            for i in range(0, len(targets), 500):
+                chunk = targets[i:i+500]
+                rows = self._db.execute(
+                    "SELECT target, length, path FROM routes WHERE fingerprint = ? AND source = ? AND target IN ({})"
+                    .format(",".join("?"*len(chunk))), [fingerprint, int(source)] + chunk).fetchall()
+                for target, length, blob in rows:
+                    found[target] = (length, decode_path(blob))
+
+            if found:
+                now = time.time()
+                self._db.executemany("UPDATE routes SET last_used = ? WHERE fingerprint = ? AND source = ? AND target = ?",
+                                     [(now, fingerprint, int(source), t) for t in found])
+
+        return found
+
+    def put_many(self, fingerprint, source, routes):
+        # routes: {target: (length, path)}
+
+        now = time.time()
+
+        with self._lock, self._db:
+            # Routes are fixed for a fingerprint, an existing row stays as it is
+            inserted = self._db.executemany("INSERT OR IGNORE INTO routes VALUES (?, ?, ?, ?, ?, ?)",
+                                            [(fingerprint, int(source), int(target), float(length), encode_path(path), now)
+                                             for target, (length, path) in routes.items()]).rowcount
+            self._count += max(inserted, 0)
+            self._evict()
+
+    def _evict(self):
+
+        if self._count <= self.max_entries:
+            return
+
+        self._count = self._db.execute("SELECT COUNT(*) FROM routes").fetchone()[0]
+        if self._count > self.max_entries:
+            self._db.execute("DELETE FROM routes WHERE rowid IN (SELECT rowid FROM routes ORDER BY last_used LIMIT ?)",
+                             (self._count - self.max_entries,))
+            self._count = self.max_entries
+
+    def clear(self):
+
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM routes")
+            self._count = 0
+
+    def __len__(self):
+
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM routes").fetchone()[0]
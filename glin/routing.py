@@ -1,45 +1,338 @@
 from matplotlib.pyplot import cm
 import numpy as np
 import osmnx as ox
-import networkx as nx
 import random
 import pandas as pd
 import pickle
+import os
+import re
+import json
+import time
+import fcntl
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 
-__all__ = ["compute_paths"]
+from .graph import RoadGraph, reconstruct_path
+from .route_cache import RouteCache
+
+__all__ = ["compute_paths", "compute_route", "compute_distance_matrix", "GraphRegistry", "prepare_graph"]
 
 G_LOC = "G_map.pickle"
+GRAPH_LOC = "G_map.graph"
+
+PLACE = "Bremen, Germany"
+NETWORK_TYPE = "drive"
+
+# Memory budget for graphs held by one process, memory mapped arrays
+# count with their full size even if only part of them is resident
+GRAPH_MEMORY_MB = float(os.getenv("GLIN_GRAPH_MEMORY_MB", 2048))
+
+# Seconds between checks whether a loaded graph's pickle or arrays changed
+GRAPH_CHECK_INTERVAL = float(os.getenv("GLIN_GRAPH_CHECK_INTERVAL", 10))
+
+def graph_files(place=PLACE, network_type=NETWORK_TYPE):
+    # Pickle and array directory for a place, Bremen keeps the original names
 
-def get_G():
+    if (place, network_type) == (PLACE, NETWORK_TYPE):
+        return G_LOC, GRAPH_LOC
+
+    slug = re.sub(r"[^a-z0-9]+", "_", place.lower()).strip("_")
+    name = "G_{}_{}".format(slug, network_type)
+
+    return name + ".pickle", name + ".graph"
+
+def get_G(place=PLACE, network_type=NETWORK_TYPE, download=True):
+
+    pickle_loc, _ = graph_files(place, network_type)
 
     try:
-        G = pickle.load(open(G_LOC,"rb"))
+        G = pickle.load(open(pickle_loc,"rb"))
     except:
+        if not download:
+            raise FileNotFoundError("No road network in {}, run prepare_graph first".format(pickle_loc))
         # Download the road network
-        G = ox.graph_from_place('Bremen, Germany', network_type='drive')
-        pickle.dump(G, open(G_LOC,"wb"))
+        G = ox.graph_from_place(place, network_type=network_type)
+        pickle.dump(G, open(pickle_loc,"wb"))
 
     return G
 
-def compute_paths(origin, endpoints):
+def prepare_graph(place=PLACE, network_type=NETWORK_TYPE, hierarchy=False, witness_limit=50, download=True):
+    # Offline step: download if needed and write the array directory, so
+    # requests only ever memory map finished files
+
+    _, graph_loc = graph_files(place, network_type)
+
+    with _graph_lock(graph_loc):
+        return _build_graph(place, network_type, hierarchy, witness_limit, download)
+
+def _build_graph(place, network_type, hierarchy=False, witness_limit=50, download=True):
+    # Call with the graph lock held
+
+    pickle_loc, graph_loc = graph_files(place, network_type)
+
+    graph = RoadGraph.from_networkx(get_G(place, network_type, download))
+    if hierarchy:
+        graph.build_hierarchy(witness_limit=witness_limit)
+    graph.save(graph_loc, source=_file_version(pickle_loc))
+
+    return graph
+
+@contextmanager
+def _graph_lock(graph_loc):
+    # Exclusive between processes: one builds the array directory, the
+    # others wait and then find it up to date
+
+    with open(graph_loc + ".lock", "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def _file_version(path):
+
+    stat = os.stat(path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+def _graph_meta(graph_loc):
+    # meta.json of the published array directory, None if there is none
+
+    try:
+        with open(os.path.join(graph_loc, "meta.json")) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+def _graph_current(pickle_loc, graph_loc):
+    # Array directory exists and was built from the current pickle
+
+    meta = _graph_meta(graph_loc)
+    if meta is None:
+        return False
+
+    return not os.path.exists(pickle_loc) or meta.get("source") == _file_version(pickle_loc)
+
+class GraphRegistry(object):
+    # Process wide LRU of loaded graphs keyed by (place, network_type).
+    # Arrays are (re)built from the pickle when missing or outdated, the
+    # road network is only downloaded with download=True, otherwise that is
+    # left to prepare_graph. Loaded graphs are checked against the pickle and
+    # the published arrays every check_interval seconds and reloaded when
+    # either changed.
+
+    def __init__(self, max_bytes=GRAPH_MEMORY_MB*1024*1024, mmap_mode='r', download=False,
+                 check_interval=GRAPH_CHECK_INTERVAL):
+
+        self.max_bytes = max_bytes
+        self.mmap_mode = mmap_mode
+        self.download = download
+        self.check_interval = check_interval
+        self._graphs = OrderedDict()
+        self._checked = {}
+        self._lock = threading.Lock()
+
+    def get(self, place=PLACE, network_type=NETWORK_TYPE):
+
+        key = (place, network_type)
+
+        with self._lock:
+            graph = self._graphs.get(key)
+            if graph is not None and not self._outdated(key, graph):
+                self._graphs.move_to_end(key)
+                return graph
+
+            graph = self._load(place, network_type)
+            self._graphs[key] = graph
+            self._graphs.move_to_end(key)
+            self._checked[key] = time.monotonic()
+            self._evict()
+
+        return graph
+
+    def _outdated(self, key, graph):
+        # Throttled check for a rebuilt pickle, or arrays published by another process
+
+        now = time.monotonic()
+        if now - self._checked[key] < self.check_interval:
+            return False
+        self._checked[key] = now
+
+        pickle_loc, graph_loc = graph_files(*key)
+
+        return os.path.realpath(graph_loc) != graph.path or not _graph_current(pickle_loc, graph_loc)
+
+    def _load(self, place, network_type):
+
+        pickle_loc, graph_loc = graph_files(place, network_type)
+
+        # Build the arrays when missing or the pickle changed since they were written
+        if not _graph_current(pickle_loc, graph_loc):
+            with _graph_lock(graph_loc):
+                # Another process may have built them while this one waited
+                if not _graph_current(pickle_loc, graph_loc):
+                    if not self.download and not os.path.exists(pickle_loc):
+                        raise FileNotFoundError("No graph for {} ({}), run prepare_graph first".format(place, network_type))
+                    meta = _graph_meta(graph_loc) or {}
+                    _build_graph(place, network_type, hierarchy=meta.get("hierarchy", False), download=self.download)
+
+        return RoadGraph.load(graph_loc, mmap_mode=self.mmap_mode)
+
+    def _evict(self):
+        # Drop least recently used graphs, the newest one always stays
+
+        while len(self._graphs) > 1 and self.nbytes > self.max_bytes:
+            key, _ = self._graphs.popitem(last=False)
+            del self._checked[key]
+
+    @property
+    def nbytes(self):
+        return sum(graph.nbytes for graph in self._graphs.values())
+
+    def clear(self):
+
+        with self._lock:
+            self._graphs.clear()
+            self._checked.clear()
+
+GRAPHS = GraphRegistry()
+
+def get_graph(place=PLACE, network_type=NETWORK_TYPE):
+
+    return GRAPHS.get(place, network_type)
+
+def build_hierarchy(place=PLACE, network_type=NETWORK_TYPE, witness_limit=50):
+    # Offline preprocessing, makes compute_route use contraction hierarchy queries
+
+    graph = prepare_graph(place, network_type, hierarchy=True, witness_limit=witness_limit)
+    GRAPHS.clear()
+
+    return graph
+
+ROUTE_CACHE = None
+
+def get_route_cache():
+
+    global ROUTE_CACHE
+    if ROUTE_CACHE is None:
+        ROUTE_CACHE = RouteCache()
+
+    return ROUTE_CACHE
+
+def compute_route(origin, destination, place=PLACE, network_type=NETWORK_TYPE):
+    # Point-to-point route between two (lat, lon) pairs
+
+    graph = get_graph(place, network_type)
+
+    source, target = graph.nearest_nodes([origin[0], destination[0]], [origin[1], destination[1]])
+    length, path = graph.shortest_path(source, target)
+
+    return length/1000, graph.node_ids[path].tolist() # m to Km
+
+def compute_paths(origin, endpoints, radius=None, place=PLACE, network_type=NETWORK_TYPE, cache=True):
+    # origin: (lat, lon) of the distribution center, e.g. config["Center"]
+    # endpoints: {BlobId: (lat, lon)} of the blob centroids
+    # radius: maximum road distance in Km, e.g. config["Radius"]
+    # cache: look up and store routes in the persistent route cache
+
+    graph = get_graph(place, network_type)
+
+    blob_ids = list(endpoints.keys())
+    points = np.array([origin] + [endpoints[i] for i in blob_ids], dtype=np.float64).reshape(-1, 2)
+
+    # Snap the origin and all blob centroids in one query. The cache is keyed
+    # by OSM ids, the search runs on array indices of just these nodes.
+    snapped = graph.nearest_nodes(points[:, 0], points[:, 1])
+    nodes = graph.node_ids[snapped]
+    index = dict(zip(nodes.tolist(), snapped.tolist()))
+    source, targets = int(nodes[0]), nodes[1:].tolist()
+
+    routes = get_route_cache().get_many(graph.fingerprint, source, targets) if cache else {}
+
+    # Only search for what the cache did not have. Settled distances are
+    # exact whatever the cutoff, so they can be stored for any radius.
+    missing = set(targets) - set(routes)
+    if missing:
+        cutoff = radius*1000 if radius is not None else None # Km to m
+        lengths, pred = graph.shortest_paths(index[source], [index[t] for t in missing], cutoff=cutoff)
+
+        found = {}
+        for target in missing:
+            i = index[target]
+            if i in lengths:
+                found[target] = (lengths[i], graph.node_ids[reconstruct_path(pred, i)].tolist())
+
+        routes.update(found)
+        if cache and found:
+            get_route_cache().put_many(graph.fingerprint, source, found)
+
+    # Blobs that could not be reached within the radius are dropped
+    rows = []
+    for blob_id, target in zip(blob_ids, targets):
+        if target not in routes:
+            continue
+        length = routes[target][0]/1000 # m to Km
+        if radius is not None and length > radius:
+            continue
+        rows.append([blob_id, len(rows)+1, length, 0., length, 0., 0., routes[target][1]])
+
+    return pd.DataFrame(rows,
+    columns =['BlobId', 'RouteId', 'TotalDistance','RailDistance', 'RoadDistance','PortDistance','AirDistance','Route'])
+
+def _search_origin(args):
+    # Worker task: one bounded search from an origin node to all targets.
+    # Workers get the graph from their own registry, the mapped arrays are
+    # shared through the page cache.
+
+    source, targets, cutoff, with_paths, place, network_type = args
+    graph = get_graph(place, network_type)
+
+    lengths, pred = graph.shortest_paths(source, targets, cutoff=cutoff)
+    row = np.array([lengths.get(t, np.inf) for t in targets])/1000 # m to Km
+
+    paths = None
+    if with_paths:
+        paths = [graph.node_ids[reconstruct_path(pred, t)].tolist() if t in lengths else None for t in targets]
+
+    return row, paths
+
+def compute_distance_matrix(origins, endpoints, radius=None, return_paths=False, processes=None,
+                            place=PLACE, network_type=NETWORK_TYPE):
+    # origins: list of (lat, lon) depots
+    # endpoints: {BlobId: (lat, lon)} of the blob centroids
+    # Returns a (len(origins), len(endpoints)) matrix in Km, np.inf where a
+    # blob is unreachable within the radius. With return_paths the node
+    # sequences are returned as well, keyed by (origin index, BlobId).
+
+    graph = get_graph(place, network_type)
+
+    blob_ids = list(endpoints.keys())
+    points = np.array(list(origins) + [endpoints[i] for i in blob_ids], dtype=np.float64).reshape(-1, 2)
 
-    G = get_G()
+    # Snap everything at once, blobs sharing a road node are searched once
+    nodes = graph.nearest_nodes(points[:, 0], points[:, 1])
+    sources = nodes[:len(origins)]
+    targets, inverse = np.unique(nodes[len(origins):], return_inverse=True)
 
-    nodes = []
-    for i in endpoints.values():
-        nodes.append(ox.nearest_nodes(G, origin, i))
+    cutoff = radius*1000 if radius is not None else None # Km to m
+    tasks = [(int(source), targets.tolist(), cutoff, return_paths, place, network_type) for source in sources]
 
-    route_list = []
-    for i in nodes: 
-        route = nx.shortest_path(G, i[0], i[1], weight='length')
-        route_list.append(route)
+    if processes == 1 or len(tasks) < 2:
+        results = [_search_origin(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            results = list(pool.map(_search_origin, tasks))
 
-    lengths = []
-    for i in nodes:
-        length = nx.shortest_path_length(G, i[0], i[1], weight='length')/1000 # m to Km
-        lengths.append(length)
+    matrix = np.empty((len(origins), len(blob_ids)))
+    paths = {}
+    for i, (row, origin_paths) in enumerate(results):
+        matrix[i] = row[inverse]
+        if return_paths:
+            for j, blob_id in enumerate(blob_ids):
+                paths[(i, blob_id)] = origin_paths[inverse[j]]
 
-    zeros = np.zeros(1, len(lengths))
+    if return_paths:
+        return matrix, paths
 
-    return pd.DataFrame(list(zip(endpoints.keys(), list(range(1,len(lengths)+1)), lengths, zeros, lengths, zeros, zeros)), 
-    columns =['BlobId', 'RouteId', 'TotalDistance','RailDistance', 'RoadDistance','PortDistance','AirDistance'])
+    return matrix
@@ -0,0 +1,94 @@
+import numpy as np
+import shapely.geometry
+from scipy.spatial import cKDTree
+
+from .graph import EARTH_RADIUS, haversine, _unit_vectors
+
+__all__ = ["BlobIndex"]
+
+# Km per degree of latitude, for areas of polygons given in EPSG:4326
+KM_PER_DEGREE = np.pi * EARTH_RADIUS / 180 / 1000
+
+class BlobIndex(object):
+    # Blob centroids on the unit sphere in a KD-tree, like RoadGraph.tree.
+    # Built once per extraction result, then every (Center, Radius, Size)
+    # setting is a ball query plus an exact haversine and area filter, so
+    # only nearby blobs of sufficient size are routed.
+
+    def __init__(self, ids, lats, lons, areas):
+        # areas in Km2
+
+        self.ids = list(ids)
+        self.lat = np.asarray(lats, dtype=np.float64)
+        self.lon = np.asarray(lons, dtype=np.float64)
+        self.area = np.asarray(areas, dtype=np.float64)
+        self.tree = cKDTree(_unit_vectors(self.lat, self.lon))
+
+    @classmethod
+    def from_geojson(cls, feature_collection):
+        # From Retrieve_Points.blobs_to_geojson output (centroid and area in
+        # the properties), or any polygons, e.g. plotting.dummy_pols()
+
+        ids, lats, lons, areas = [], [], [], []
+        for feature in feature_collection["features"]:
+            props = feature.get("properties") or {}
+            ids.append(props.get("id", feature.get("id")))
+
+            if "centroid" in props and "area" in props:
+                lon, lat = props["centroid"]
+                area = props["area"] / 1e6 # m2 to Km2
+            else:
+                geom = shapely.geometry.shape(feature["geometry"])
+                lon, lat = geom.centroid.x, geom.centroid.y
+                area = geom.area * KM_PER_DEGREE**2 * np.cos(np.radians(lat))
+
+            lats.append(lat)
+            lons.append(lon)
+            areas.append(area)
+
+        return cls(ids, lats, lons, areas)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def distances(self, center, positions=None):
+        # Great circle distance in Km from center (lat, lon)
+
+        if positions is None:
+            positions = slice(None)
+
+        return haversine(center[0], center[1], self.lat[positions], self.lon[positions]) / 1000
+
+    def query(self, center, radius=None, size=None, margin=0.):
+        # Positions of the blobs whose centroid lies within radius Km of
+        # center and whose area is at least size Km2, nearest first.
+        # Road distance is never shorter than the great circle distance, so
+        # compute_paths with the same radius drops all other blobs anyway;
+        # margin (Km) covers snapping to road nodes.
+
+        if radius is None:
+            positions = np.arange(len(self.ids))
+        else:
+            reach = (radius + margin) * 1000 / EARTH_RADIUS # radians
+            chord = 2 * np.sin(min(reach, np.pi) / 2)
+            positions = np.array(self.tree.query_ball_point(_unit_vectors([center[0]], [center[1]])[0], chord * (1 + 1e-9)),
+                                 dtype=np.int64)
+
+        if size is not None and len(positions):
+            positions = positions[self.area[positions] >= size]
+
+        distance = self.distances(center, positions)
+        if radius is not None:
+            keep = distance <= radius + margin
+            positions, distance = positions[keep], distance[keep]
+
+        order = np.argsort(distance, kind="stable")
+
+        return positions[order], distance[order]
+
+    def candidates(self, center, radius=None, size=None, margin=0.):
+        # {BlobId: (lat, lon)} ready for routing.compute_paths
+
+        positions, _ = self.query(center, radius, size, margin)
+
+        return {self.ids[i]: (float(self.lat[i]), float(self.lon[i])) for i in positions}
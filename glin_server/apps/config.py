@@ -16,3 +16,31 @@ class Config(object):
 
     # App Config - the minimal footprint
     SECRET_KEY = os.getenv('SECRET_KEY', 'S#perS3crEt_9999')
+
+    # Geocoding - Nominatim responses are cached on disk (osmnx compatible
+    # names), GEOCODER_GAZETTEER may point to a place CSV or a response folder
+    GEOCODER_CACHE       = os.getenv('GEOCODER_CACHE', os.path.join(basedir, '..', '..', 'cache'))
+    GEOCODER_GAZETTEER   = os.getenv('GEOCODER_GAZETTEER')
+    GEOCODER_MEMORY_SIZE = int(os.getenv('GEOCODER_MEMORY_SIZE', 1024))
+    GEOCODER_OFFLINE     = (os.getenv('GEOCODER_OFFLINE', 'False') == 'True')
+    GEOCODER_USER_AGENT  = os.getenv('GEOCODER_USER_AGENT', 'glin')
+    NOMINATIM_URL        = os.getenv('NOMINATIM_URL', 'https://nominatim.openstreetmap.org/search')
+
+    # Per-session configs live in memory and are written behind to SQLite,
+    # an empty SESSION_STORE keeps them in memory only. The memory copy is
+    # authoritative: run a single process (gunicorn.conf.py), scale with threads
+    SESSION_STORE          = os.getenv('SESSION_STORE', os.path.join(basedir, '..', 'glin_sessions.sqlite'))
+    SESSION_FLUSH_INTERVAL = float(os.getenv('SESSION_FLUSH_INTERVAL', 1.))
+    SESSION_MAX_IN_MEMORY  = int(os.getenv('SESSION_MAX_IN_MEMORY', 10000))
+
+    # Background jobs for the plot requests, finished results are reused
+    # for identical parameters during JOB_TTL seconds. Jobs live in process
+    # memory like the sessions. The page polls for progress, JOB_EVENTS
+    # streams it as server-sent events instead, each stream holding a server
+    # thread for up to JOB_EVENTS_TIMEOUT seconds before the page falls back
+    # to polling.
+    JOB_WORKERS        = int(os.getenv('JOB_WORKERS', 4))
+    JOB_TTL            = float(os.getenv('JOB_TTL', 600))
+    JOB_MAX_STORED     = int(os.getenv('JOB_MAX_STORED', 1000))
+    JOB_EVENTS         = (os.getenv('JOB_EVENTS', 'False') == 'True')
+    JOB_EVENTS_TIMEOUT = float(os.getenv('JOB_EVENTS_TIMEOUT', 30))
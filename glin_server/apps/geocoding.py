@@ -0,0 +1,265 @@
+# -*- encoding: utf-8 -*-
+"""
+Address lookup with an in-memory LRU, a persistent Nominatim response cache
+and an optional offline gazetteer, so repeated lookups never hit the network.
+"""
+
+import os
+import re
+import csv
+import json
+import bisect
+import hashlib
+import threading
+from collections import OrderedDict, defaultdict
+
+import requests as req
+
+NOMINATIM_URL = "https://nominatim.openstreetmap.org/search"
+
+# Parameters osmnx uses for place lookups, its cached responses (e.g. the
+# ones in cache/) are found under the same key
+OSMNX_PARAMS = {"format": "json", "polygon_geojson": 1, "dedupe": 0, "limit": 50}
+
+def cache_key(url, params):
+    # Same naming as the osmnx cache: SHA1 of the prepared request URL
+
+    prepared = req.Request("GET", url, params=params).prepare().url
+    return hashlib.sha1(prepared.encode("utf-8")).hexdigest()
+
+def normalize(text):
+
+    return " ".join(re.sub(r"[^\w]+", " ", text.lower()).split())
+
+def trigrams(text):
+
+    text = "  {} ".format(text)
+    return {text[i:i+3] for i in range(len(text)-2)}
+
+class Gazetteer(object):
+    # Offline place index. Names are kept sorted for prefix search and in a
+    # trigram inverted index for misspelled or partial queries.
+
+    def __init__(self, places, min_similarity=0.4):
+        # places: iterable of (name, lat, lon, importance)
+
+        self.min_similarity = min_similarity
+        self.places = []
+        entries = {}
+
+        for name, lat, lon, importance in places:
+            place = (name, float(lat), float(lon), float(importance or 0.))
+            i = len(self.places)
+            self.places.append(place)
+
+            # Full name and its first component ("Bremen" for "Bremen, Free Hanseatic City of Bremen, Germany")
+            for key in {normalize(name), normalize(name.split(",")[0])}:
+                if key and (key not in entries or self.places[entries[key]][3] < place[3]):
+                    entries[key] = i
+
+        self.names = sorted(entries)
+        self.index = [entries[name] for name in self.names]
+
+        self.grams = defaultdict(list)
+        for k, name in enumerate(self.names):
+            for gram in trigrams(name):
+                self.grams[gram].append(k)
+
+    @classmethod
+    def from_csv(cls, path, **kwargs):
+        # Columns name, lat, lon and optionally importance, e.g. exported from an OSM place extract
+
+        with open(path, newline="", encoding="utf-8") as f:
+            rows = [(row["name"], row["lat"], row["lon"], row.get("importance")) for row in csv.DictReader(f)]
+
+        return cls(rows, **kwargs)
+
+    @classmethod
+    def from_nominatim_cache(cls, folder, **kwargs):
+        # Every place found in cached Nominatim responses
+
+        rows = []
+        for name in sorted(os.listdir(folder)):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(folder, name), encoding="utf-8") as f:
+                    resp = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if isinstance(resp, list):
+                rows += [(info["display_name"], info["lat"], info["lon"], info.get("importance"))
+                         for info in resp if "display_name" in info]
+
+        return cls(rows, **kwargs)
+
+    @classmethod
+    def from_file(cls, path, **kwargs):
+
+        if os.path.isdir(path):
+            return cls.from_nominatim_cache(path, **kwargs)
+        return cls.from_csv(path, **kwargs)
+
+    def __len__(self):
+        return len(self.places)
+
+    def search(self, query, limit=5):
+        # [(score, (name, lat, lon, importance))], exact match scores 1,
+        # prefix matches 0.9, the rest their trigram similarity
+
+        query = normalize(query)
+        if not query:
+            return []
+
+        scores = {}
+
+        start = bisect.bisect_left(self.names, query)
+        end = bisect.bisect_right(self.names, query + "\uffff")
+        for k in range(start, min(end, start + 100)):
+            scores[k] = 1. if self.names[k] == query else .9
+
+        if len(scores) < limit:
+            grams = trigrams(query)
+            shared = defaultdict(int)
+            for gram in grams:
+                for k in self.grams.get(gram, ()):
+                    shared[k] += 1
+            for k, n in shared.items():
+                similarity = n / (len(grams) + len(trigrams(self.names[k])) - n)
+                if similarity >= self.min_similarity and k not in scores:
+                    scores[k] = similarity
+
+        # A place is indexed under several names, keep its best one
+        best = {}
+        for k, score in scores.items():
+            i = self.index[k]
+            best[i] = max(score, best.get(i, 0.))
+
+        ranked = sorted(best.items(), key=lambda item: (-item[1], -self.places[item[0]][3]))
+
+        return [(score, self.places[i]) for i, score in ranked[:limit]]
+
+    def lookup(self, query, min_score=0.):
+        # (lat, lon) of the best match, None without one
+
+        hits = self.search(query, limit=1)
+        if not hits or hits[0][0] < min_score:
+            return None
+
+        _, lat, lon, _ = hits[0][1]
+        return lat, lon
+
+class Geocoder(object):
+    # Lookup order: memory, gazetteer, disk cache, Nominatim. Network results
+    # are written to the disk cache. Addresses Nominatim does not know are
+    # remembered in memory as well, failed requests are not.
+
+    def __init__(self, cache_folder=None, memory_size=1024, gazetteer=None, offline=False,
+                 url=NOMINATIM_URL, user_agent="glin", timeout=10):
+
+        self.cache_folder = cache_folder
+        self.memory_size = memory_size
+        self.gazetteer = gazetteer
+        self.offline = offline
+        self.url = url
+        self.user_agent = user_agent
+        self.timeout = timeout
+
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+
+        if cache_folder is not None:
+            os.makedirs(cache_folder, exist_ok=True)
+
+    @classmethod
+    def from_config(cls, config):
+
+        gazetteer = None
+        if config.get("GEOCODER_GAZETTEER"):
+            gazetteer = Gazetteer.from_file(config["GEOCODER_GAZETTEER"])
+
+        return cls(cache_folder=config.get("GEOCODER_CACHE"),
+                   memory_size=config.get("GEOCODER_MEMORY_SIZE", 1024),
+                   gazetteer=gazetteer,
+                   offline=config.get("GEOCODER_OFFLINE", False),
+                   url=config.get("NOMINATIM_URL", NOMINATIM_URL),
+                   user_agent=config.get("GEOCODER_USER_AGENT", "glin"))
+
+    def geocode(self, address):
+        # (lat, lon) of an address, None if nothing was found
+
+        key = normalize(address)
+
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key]
+
+        center = None
+        if self.gazetteer is not None:
+            # Only exact and prefix matches, a fuzzy hit is no reason to skip Nominatim
+            center = self.gazetteer.lookup(address, min_score=.9)
+        if center is None:
+            try:
+                center = self._from_nominatim(address)
+            except (req.RequestException, ValueError, LookupError) as e:
+                print("Geocoding failed: {}".format(e))
+                return None
+
+        with self._lock:
+            self._memory[key] = center
+            while len(self._memory) > self.memory_size:
+                self._memory.popitem(last=False)
+
+        return center
+
+    def _from_nominatim(self, address):
+
+        params = {"q": address, "format": "json"}
+
+        resp = self._read_cache(params)
+        if resp is None:
+            resp = self._read_cache(dict(OSMNX_PARAMS, q=address))
+        if resp is None:
+            if self.offline:
+                raise LookupError("{} is not cached and the geocoder is offline".format(address))
+            http = req.get(self.url, params=params, headers={"User-Agent": self.user_agent}, timeout=self.timeout)
+            http.raise_for_status()
+            resp = http.json()
+            self._write_cache(params, resp)
+
+        if len(resp) == 0:
+            return None
+
+        return float(resp[0]["lat"]), float(resp[0]["lon"])
+
+    def _cache_path(self, params):
+
+        return os.path.join(self.cache_folder, cache_key(self.url, params) + ".json")
+
+    def _read_cache(self, params):
+
+        if self.cache_folder is None:
+            return None
+
+        try:
+            with open(self._cache_path(params), encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_cache(self, params, resp):
+
+        if self.cache_folder is None:
+            return
+
+        path = self._cache_path(params)
+        tmp = "{}.{}.tmp".format(path, threading.get_ident())
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(resp, f)
+        os.replace(tmp, path)
+
+    def clear(self):
+
+        with self._lock:
+            self._memory.clear()
@@ -0,0 +1,166 @@
+# -*- encoding: utf-8 -*-
+"""
+Background jobs for the slow request paths: a local worker pool, a result
+store and progress reporting. Identical requests share one job.
+"""
+
+import time
+import uuid
+import threading
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+class Job(object):
+
+    def __init__(self, key):
+
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.status = QUEUED
+        self.progress = 0.
+        self.message = ""
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+        self.version = 0
+        self._changed = threading.Condition()
+
+    def _update(self, **attrs):
+
+        with self._changed:
+            for name, value in attrs.items():
+                setattr(self, name, value)
+            self.version += 1
+            self._changed.notify_all()
+
+    def set_progress(self, progress, message=""):
+        # Called by the job function, progress in [0, 1]
+
+        self._update(progress=float(progress), message=message)
+
+    @property
+    def done(self):
+        return self.status in (DONE, FAILED)
+
+    def wait_change(self, version, timeout=None):
+        # Block until the job changed after the given version, returns the new version
+
+        with self._changed:
+            self._changed.wait_for(lambda: self.version != version, timeout)
+            return self.version
+
+    def wait(self, timeout=None):
+
+        with self._changed:
+            self._changed.wait_for(lambda: self.done, timeout)
+        return self.done
+
+    def to_dict(self):
+
+        info = {"id": self.id, "status": self.status, "progress": self.progress, "message": self.message}
+        if self.status == FAILED:
+            info["error"] = self.error
+        if self.status == DONE:
+            info["result"] = self.result
+        return info
+
+class JobManager(object):
+    # Jobs are keyed by their parameters: submitting a key that is queued,
+    # running or finished less than ttl seconds ago returns the existing job
+    # instead of starting a new computation. Failed jobs are not reused.
+    # Jobs are only known to the process that runs them, so the server must
+    # be a single process (see gunicorn.conf.py).
+
+    def __init__(self, max_workers=4, ttl=600., max_jobs=1000):
+
+        self.ttl = ttl
+        self.max_jobs = max_jobs
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="glin-job")
+        self._jobs = OrderedDict()
+        self._by_key = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+
+        return cls(max_workers=config.get("JOB_WORKERS", 4),
+                   ttl=config.get("JOB_TTL", 600.),
+                   max_jobs=config.get("JOB_MAX_STORED", 1000))
+
+    def submit(self, key, fn, *args, **kwargs):
+        # fn(job, *args, **kwargs) runs in the pool, its return value is the job result
+
+        with self._lock:
+            self._expire()
+
+            job = self._by_key.get(key)
+            if job is not None and job.status != FAILED:
+                return job
+
+            job = Job(key)
+            self._jobs[job.id] = job
+            self._by_key[key] = job
+
+        self._pool.submit(self._run, job, fn, args, kwargs)
+
+        return job
+
+    def _run(self, job, fn, args, kwargs):
+
+        job._update(status=RUNNING)
+        try:
+            result = fn(job, *args, **kwargs)
+        except Exception as e:
+            traceback.print_exc()
+            job._update(status=FAILED, error="{}: {}".format(type(e).__name__, e), finished=time.time())
+        else:
+            job._update(status=DONE, progress=1., result=result, finished=time.time())
+
+    def _expire(self):
+        # Forget old finished jobs, oldest first. Call with the lock held.
+
+        now = time.time()
+        for job_id, job in list(self._jobs.items()):
+            expired = job.done and now - job.finished > self.ttl
+            if not expired and len(self._jobs) <= self.max_jobs:
+                continue
+            if not job.done:
+                continue
+            del self._jobs[job_id]
+            if self._by_key.get(job.key) is job:
+                del self._by_key[job.key]
+
+    def get(self, job_id):
+
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def events(self, job, timeout=30., heartbeat=15.):
+        # Job states for a server-sent event stream, one per change until the
+        # job is done or timeout seconds passed. None as a keep-alive when
+        # nothing changed for heartbeat seconds.
+
+        version = -1
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            new_version = job.wait_change(version, timeout=min(heartbeat, max(deadline - time.time(), 0.)))
+            if new_version == version:
+                yield None
+                continue
+            version = new_version
+            yield job.to_dict()
+            if job.done:
+                return
+
+    def shutdown(self, wait=True):
+
+        self._pool.shutdown(wait=wait)
+
+    def __len__(self):
+
+        with self._lock:
+            return len(self._jobs)
@@ -0,0 +1,232 @@
+# -*- encoding: utf-8 -*-
+"""
+Per-session configuration kept in memory, with atomic updates and optional
+write-behind persistence to SQLite.
+"""
+
+import copy
+import json
+import time
+import atexit
+import sqlite3
+import threading
+from collections import OrderedDict
+
+DEFAULT_CONFIG = {"Address": "Jacobs University", "Radius": 5, "Size": 0.5}
+
+class SessionStore(object):
+    # Requests only ever touch the in-memory dict. Changed sessions are marked
+    # dirty and written by a background thread every flush_interval seconds,
+    # sessions not in memory (evicted, server restart) are read back lazily.
+    #
+    # Every change bumps the session's version, which is stored with the row.
+    # A write never replaces a newer version, and a session stays dirty until
+    # the write of its current version has committed, so neither a delayed
+    # flush nor an eviction in between loses an update.
+    #
+    # The in-memory copy is authoritative, so one SQLite file must be used by
+    # a single process only (see gunicorn.conf.py): a second process would
+    # serve its own stale copy and its writes would be dropped.
+
+    def __init__(self, path=None, flush_interval=1., max_sessions=10000, default=None):
+        # path: SQLite file, None keeps sessions in memory only
+
+        self.path = path
+        self.flush_interval = flush_interval
+        self.max_sessions = max_sessions
+        self.default = copy.deepcopy(default if default is not None else DEFAULT_CONFIG)
+
+        self._sessions = OrderedDict()
+        self._versions = {}
+        self._dirty = {}
+        self._evicted = {}
+        self._loading = {}
+        self._lock = threading.RLock()
+        self._db_lock = threading.Lock()
+        self._read_lock = threading.Lock()
+        self._db = None
+        self._reader = None
+        self._stop = threading.Event()
+        self._writer = None
+
+        if path is not None:
+            self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+            # WAL: reads do not wait for the write-behind transaction
+            self._db.execute("PRAGMA journal_mode=WAL")
+            with self._db_lock, self._db:
+                self._db.execute("""CREATE TABLE IF NOT EXISTS sessions (
+                    sid TEXT PRIMARY KEY, config TEXT, updated REAL, version INTEGER DEFAULT 0)""")
+                columns = [row[1] for row in self._db.execute("PRAGMA table_info(sessions)")]
+                if "version" not in columns:
+                    self._db.execute("ALTER TABLE sessions ADD COLUMN version INTEGER DEFAULT 0")
+            self._reader = sqlite3.connect(path, timeout=30, check_same_thread=False)
+
+            self._writer = threading.Thread(target=self._write_behind, daemon=True)
+            self._writer.start()
+            atexit.register(self.close)
+
+    @classmethod
+    def from_config(cls, config):
+
+        return cls(path=config.get("SESSION_STORE") or None,
+                   flush_interval=config.get("SESSION_FLUSH_INTERVAL", 1.),
+                   max_sessions=config.get("SESSION_MAX_IN_MEMORY", 10000))
+
+    def _cached(self, sid):
+        # Session config in memory, None if it must be read. Call with the lock held.
+
+        if sid in self._sessions:
+            self._sessions.move_to_end(sid)
+            return self._sessions[sid]
+
+        if sid in self._evicted:
+            # Evicted but not written yet, back in memory and still dirty
+            version, config = self._evicted.pop(sid)
+            self._sessions[sid] = config
+            self._versions[sid] = version
+            self._dirty[sid] = version
+            self._evict()
+            return config
+
+        return None
+
+    def _read(self, sid):
+        # Read a session into memory from the database or the default. Called
+        # without the lock, concurrent requests for one sid wait for one read.
+
+        with self._lock:
+            if self._cached(sid) is not None:
+                return
+            loading = self._loading.get(sid)
+            if loading is None:
+                loading = self._loading[sid] = threading.Event()
+                reader = True
+            else:
+                reader = False
+
+        if not reader:
+            loading.wait()
+            return
+
+        try:
+            config, version = None, 0
+            if self._reader is not None:
+                with self._read_lock:
+                    row = self._reader.execute("SELECT config, version FROM sessions WHERE sid = ?", (sid,)).fetchone()
+                if row is not None:
+                    config, version = json.loads(row[0]), row[1] or 0
+
+            if config is None:
+                config = copy.deepcopy(self.default)
+
+            with self._lock:
+                self._sessions[sid] = config
+                self._versions[sid] = version
+                self._evict()
+        finally:
+            with self._lock:
+                del self._loading[sid]
+            loading.set()
+
+    def _access(self, sid, fn):
+        # fn(config) with the lock held, config being the stored session config
+
+        while True:
+            with self._lock:
+                config = self._cached(sid)
+                if config is not None:
+                    return fn(config)
+            self._read(sid)
+
+    def _evict(self):
+        # Least recently used sessions leave memory. Unsaved ones wait in
+        # _evicted for the next flush. Call with the lock held.
+
+        while len(self._sessions) > self.max_sessions:
+            sid, config = self._sessions.popitem(last=False)
+            version = self._versions.pop(sid)
+            if self._dirty.pop(sid, None) is not None and self._db is not None:
+                self._evicted[sid] = (version, config)
+
+    def get(self, sid):
+        # Copy of the session config, changes to it are not stored
+
+        return self._access(sid, copy.deepcopy)
+
+    def set(self, sid, config):
+
+        def replace(stored):
+            self._sessions[sid] = copy.deepcopy(config)
+            self._touch(sid)
+
+        self._access(sid, replace)
+
+    def update(self, sid, changes):
+        # Atomic read-modify-write. changes: dict of keys to set, or a function
+        # modifying the config in place. Returns a copy of the new config.
+
+        def modify(stored):
+            config = copy.deepcopy(stored)
+            if callable(changes):
+                changes(config)
+            else:
+                config.update(changes)
+            self._sessions[sid] = config
+            self._touch(sid)
+
+            return copy.deepcopy(config)
+
+        return self._access(sid, modify)
+
+    def _touch(self, sid):
+        # New version of a changed session. Call with the lock held.
+
+        self._versions[sid] += 1
+        self._dirty[sid] = self._versions[sid]
+
+    def _save(self, configs):
+        # configs: {sid: (version, config)}, rows holding a newer version are kept
+
+        if self._db is None or not configs:
+            return
+
+        now = time.time()
+        with self._db_lock, self._db:
+            self._db.executemany("""INSERT INTO sessions (sid, config, updated, version) VALUES (?, ?, ?, ?)
+                ON CONFLICT(sid) DO UPDATE SET config = excluded.config, updated = excluded.updated,
+                    version = excluded.version WHERE excluded.version > sessions.version""",
+                [(sid, json.dumps(config), now, version) for sid, (version, config) in configs.items()])
+
+    def flush(self):
+        # Write all dirty and evicted sessions now. They stay dirty until the
+        # write has committed, and stay dirty after it if they changed meanwhile.
+
+        with self._lock:
+            configs = dict(self._evicted)
+            configs.update((sid, (version, copy.deepcopy(self._sessions[sid]))) for sid, version in self._dirty.items())
+
+        self._save(configs)
+
+        with self._lock:
+            for sid, (version, _) in configs.items():
+                if self._dirty.get(sid) == version:
+                    del self._dirty[sid]
+                if self._evicted.get(sid, (None,))[0] == version:
+                    del self._evicted[sid]
+
+    def _write_behind(self):
+
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+
+        self._stop.set()
+        if self._writer is not None and self._writer is not threading.current_thread():
+            self._writer.join()
+        self.flush()
+
+    def __len__(self):
+
+        with self._lock:
+            return len(self._sessions)
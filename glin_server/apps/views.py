@@ -4,11 +4,10 @@ Copyright (c) 2019 - present AppSeed.us
 """
 
 # Flask modules
-from flask   import render_template, request
+from flask   import render_template, request, session, jsonify, Response, stream_with_context
 from jinja2  import TemplateNotFound
 
-import pickle
-import requests as req
+import uuid
 
 import glin.ranking as ranking
 import glin.routing as routing
@@ -18,12 +17,19 @@ import random
 
 # App modules
 from apps import app
+from apps.geocoding import Geocoder
+from apps.sessions import SessionStore
+from apps.jobs import JobManager
 
 import pandas as pd
 import json
 import plotly
 import plotly.express as px
 
+geocoder = Geocoder.from_config(app.config)
+sessions = SessionStore.from_config(app.config)
+jobs = JobManager.from_config(app.config)
+
 # App main route + generic routing
 @app.route('/', defaults={'path': 'index.html'})
 @app.route('/<path>')
@@ -35,7 +41,8 @@ def index(path):
         segment = get_segment( request )
 
         # Serve the file (if exists) from app/templates/home/FILE.html
-        return render_template( 'home/' + path, segment=segment, graphJSON=make_plot(get_info()) )
+        return render_template( 'home/' + path, segment=segment, graphJSON=make_plot(locate(get_info())),
+                                job_events=app.config["JOB_EVENTS"] )
     
     except TemplateNotFound:
         return render_template('home/page-404.html'), 404
@@ -43,43 +50,66 @@ def index(path):
 @app.route('/address', methods=["GET", "POST"])
 def cb_address():
 
-    config = get_info()
-    config["Address"] = request.args.get('data')
-
-    update_address(config)
+    config = commit_info({"Address": request.args.get('data')})
+    config = locate(config)
 
-    commit_info(config)
-
-    return make_plot(config)
+    return jsonify(submit_plot(config).to_dict())
 
 @app.route('/radius', methods=["GET", "POST"])
 def cb_radius():
 
-    config = get_info()
-    update_address(config)
+    config = commit_info({"Radius": float(request.args.get('data'))})
+    config = locate(config)
 
-    config["Radius"] = float(request.args.get('data'))
-
-    commit_info(config)
-
-    return make_plot(config)
+    return jsonify(submit_plot(config).to_dict())
 
 @app.route('/size', methods=["GET", "POST"])
 def cb_size():
 
-    config = get_info()
-    update_address(config)
+    config = commit_info({"Size": float(request.args.get('data'))})
+    config = locate(config)
+
+    return jsonify(submit_plot(config).to_dict())
 
-    config["Size"] = float(request.args.get('data'))
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
 
-    commit_info(config)
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({"id": job_id, "status": "unknown"}), 404
 
-    return make_plot(config)
+    return jsonify(job.to_dict())
 
-def make_plot(config):
+@app.route('/jobs/<job_id>/events')
+def job_events(job_id):
+
+    # Opt-in: every open stream holds a server thread
+    job = jobs.get(job_id) if app.config["JOB_EVENTS"] else None
+    if job is None:
+        return jsonify({"id": job_id, "status": "unknown"}), 404
+
+    def stream():
+        for info in jobs.events(job, timeout=app.config["JOB_EVENTS_TIMEOUT"]):
+            # Comment lines keep the connection open while nothing changes
+            yield ": keep-alive\n\n" if info is None else "data: {}\n\n".format(json.dumps(info))
+
+    return Response(stream_with_context(stream()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+def submit_plot(config):
+
+    # Requests with the same parameters share one computation
+    key = (tuple(config.get("Center") or ()), float(config["Radius"]), float(config["Size"]))
+
+    return jobs.submit(key, lambda job: make_plot(config, job))
+
+def make_plot(config, job=None):
 
     print("Making plot")
 
+    if job is not None:
+        job.set_progress(0.1, "Routing")
+
     # Otto's comes here
 
     # routing.compute_paths(config["Center"], )
@@ -87,6 +117,9 @@ def make_plot(config):
     poly_json = plotting.dummy_pols()
     scores = plotting.dummy_scores()
 
+    if job is not None:
+        job.set_progress(0.8, "Plotting")
+
     return plotting.plot_polygons(poly_json, scores, config["Center"][0], config["Center"][1], zoom=8)
 
 def get_segment( request ): 
@@ -102,28 +135,51 @@ def get_segment( request ):
     except:
         return None  
 
+def session_id():
+
+    # Signed cookie holding only a random id, the config stays on the server
+    if "sid" not in session:
+        session["sid"] = uuid.uuid4().hex
+
+    return session["sid"]
+
 def get_info():
 
-    try:
-        config = pickle.load(open("glin_config.pickle",'rb'))
-    except:
-        config = {"Address":"Jacobs University", "Radius": 5, "Size":0.5}
+    return sessions.get(session_id())
 
-    return config
+def commit_info(changes):
+
+    # Atomic update of this session's config, returns the new config
+    return sessions.update(session_id(), changes)
+
+def locate(config):
+
+    address = config.get("CenterAddress")
+    update_address(config)
+
+    if config.get("CenterAddress") != address:
 
-def commit_info(config):
+        def set_center(stored):
+            # Skip if another request changed the address meanwhile
+            if stored["Address"] == config["CenterAddress"]:
+                stored["Center"] = config["Center"]
+                stored["CenterAddress"] = config["CenterAddress"]
 
-    pickle.dump(config, open("glin_config.pickle",'wb'))
+        commit_info(set_center)
+
+    return config
 
 def update_address(config):
-    
-    resp = req.get("https://nominatim.openstreetmap.org/search", params={"q":config["Address"],"format":"json"})
-    resp = resp.json()
 
-    if len(resp) == 0:
+    # Center is still valid for this address
+    if "Center" in config and config.get("CenterAddress") == config["Address"]:
+        return
+
+    center = geocoder.geocode(config["Address"])
+
+    if center is None:
         print("There is no address found")
         return
-    
-    info = resp[0]
 
-    config["Center"] = [float(info["lat"]), float(info["lon"])]
+    config["Center"] = [center[0], center[1]]
+    config["CenterAddress"] = config["Address"]
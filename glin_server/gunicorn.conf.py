@@ -0,0 +1,20 @@
+# -*- encoding: utf-8 -*-
+"""
+Gunicorn settings, read from the working directory: gunicorn run:app
+
+Sessions are held in memory and only written behind to SQLite
+(apps/sessions.py), and plot jobs with their results only exist in the
+process that runs them (apps/jobs.py), so the app must run in a single
+process. Concurrency comes from threads instead of worker processes.
+"""
+
+import os
+
+workers = 1
+threads = int(os.getenv('GUNICORN_THREADS', 8))
+
+def on_starting(server):
+
+    if server.cfg.workers != 1:
+        raise RuntimeError("glin_server keeps its sessions and jobs in process memory and must run "
+                           "with a single worker, got --workers {}. Raise --threads instead.".format(server.cfg.workers))